@@ -5,6 +5,7 @@
 import copy
 import itertools
 import os
+import shutil
 import time
 
 # Third party imports
@@ -61,6 +62,18 @@ d_config_mad["optics_file"] = "acc-models-lhc/strengths/ramp/opt_ramp_500_1500_t
 d_config_mad["ver_hllhc_optics"] = 1.6
 
 
+# Save the base collider in binary format, memory-mapped when loaded in generation 2 (much faster
+# than parsing the zipped json). The binary file is checked against the saved collider in
+# generation 1, but the format is still experimental, so it is disabled by default
+dump_collider_binary = False
+
+# Global store in which the base colliders are kept, such that studies sharing the same mad
+# configuration (and optics and sequence files) don't rebuild it (None to disable). The least
+# recently used colliders are evicted when the store exceeds the given size (in GB). To enable it,
+# set an absolute path, e.g. os.path.abspath("../base_collider_store")
+base_collider_store = None
+base_collider_store_max_size_gb = 50
+
 # Beam energy (for both beams)
 beam_energy_tot = 7000
 d_config_mad["beam_config"]["lhcb1"]["beam_energy_tot"] = beam_energy_tot
@@ -197,12 +210,41 @@ d_config_simulation = {}
 # Number of turns to track
 d_config_simulation["n_turns"] = 100
 
+# Number of turns after which the particles are saved to a checkpoint, from which the tracking is
+# resumed if the job is evicted or killed (None to track all the turns in one go). Combined with
+# cache_configured_collider, a restarted job doesn't configure the collider again either
+d_config_simulation["n_turns_checkpoint"] = None
+
+# If True, the tracking is done by blocks of turns, and the particles above the smallest lost
+# amplitude of their angle are deactivated after each block, as they can't change the DA anymore
+d_config_simulation["prune_lost_amplitudes"] = False
+d_config_simulation["n_turns_pruning"] = 100
+
 # Initial off-momentum
 d_config_simulation["delta_max"] = 27.0e-5
 
 # Beam to track (lhcb1 or lhcb2)
 d_config_simulation["beam"] = "lhcb1"
 
+# If True, only the amplitudes needed to find the DA boundary of each angle are tracked (a coarse
+# set of amplitudes, then refinement rounds around the boundary). Particles not tracked over all
+# the turns are considered lost above the boundary, and stable below it, such that the
+# postprocessing is unchanged. The coarse pass can be limited to n_turns_coarse turns (None for
+# all the turns), the particles surviving it being tracked further only if they are needed to
+# locate the boundary. Not compatible with checkpoints and pruning
+d_config_simulation["adaptive_da"] = False
+d_config_simulation["n_amplitudes_coarse"] = 16
+d_config_simulation["n_amplitudes_refine"] = 4
+d_config_simulation["n_turns_coarse"] = None
+
+# If True, a single job per working point configures the collider once and tracks all the particle
+# chunks (one output file per chunk), instead of having one job per chunk
+track_all_chunks_in_one_job = False
+
+# Number of local processes used to track the chunks in parallel when they are tracked in a single
+# job (only on CPU, and the job should request the corresponding number of cores)
+d_config_simulation["n_workers_chunks"] = 1
+
 # ==================================================================================================
 # --- Dump collider and collider configuration
 #
@@ -212,6 +254,46 @@ d_config_simulation["beam"] = "lhcb1"
 dump_collider = False
 dump_config_in_collider = False
 
+# ==================================================================================================
+# --- Outputs of the jobs
+#
+# Below, the user chooses if the configurations of the jobs must be recorded once in a config table
+# of the study (the outputs then only keep their hash, along with the scanned parameters as
+# columns), instead of in the attributes of every output. The user also chooses if the outputs must
+# also be published in a results dataset of the study, partitioned by the scanned parameters (each
+# output is then written twice), from which the postprocessing reads them.
+# ==================================================================================================
+use_config_table = False
+use_results_dataset = False
+
+# ==================================================================================================
+# --- Cache configured collider
+#
+# Below, the user chooses if the configured collider must be shared between the jobs having the
+# same collider configuration (i.e. the particle chunks of a given working point). The first job
+# configures the collider and stores it in the base collider folder, the others just load it.
+# Disabled by default, as the cache takes some disk space in the study.
+# ==================================================================================================
+cache_configured_collider = False
+
+# Below, the user chooses a per-host folder in which the base collider is cached once uncompressed
+# and parsed, such that jobs landing on the same host don't repeat this work (None to disable).
+# It must be on a local disk, and not remapped for each job (e.g. HTCondor private /tmp)
+local_cache_dir = None
+
+# Below, the user chooses if the matching of tune and chromaticity must start from the knobs of the
+# nearest working point already solved, instead of the knobs of the base collider. The starting
+# point depends on which jobs finished first, such that the results are not exactly reproducible
+# (the working point used is recorded in the output configuration, as warm_start_targets)
+warm_start_matching = False
+
+# Below, the user chooses the folder in which the compiled tracking kernels are shared between the
+# jobs (None to disable). The first job needing a kernel compiles it, the others load it. Relative
+# paths are taken from the study folder. Environment variables are expanded by the jobs, such that
+# a per-host folder can be used (e.g. "$TMPDIR/kernel_cache", or "kernel_cache" for a folder in the
+# study)
+kernel_cache_dir = None
+
 # ==================================================================================================
 # --- Machine parameters being scanned (generation 2)
 #
@@ -243,6 +325,13 @@ children["base_collider"]["config_particles"] = d_config_particles
 # Add base machine parameters to the first generation
 children["base_collider"]["config_mad"] = d_config_mad
 
+# Save the base collider in binary format if requested
+children["base_collider"]["dump_collider_binary"] = dump_collider_binary
+
+# Share the base collider between studies through the global store
+children["base_collider"]["base_collider_store"] = base_collider_store
+children["base_collider"]["base_collider_store_max_size_gb"] = base_collider_store_max_size_gb
+
 
 # ==================================================================================================
 # --- Complete tree for the simulations (generation 2)
@@ -253,7 +342,11 @@ children["base_collider"]["config_mad"] = d_config_mad
 # ! Caution when mutating the dictionnary in this function, you have to pass a deepcopy to children,
 # ! otherwise the dictionnary will be mutated for all the children.
 # ==================================================================================================
-track_array = np.arange(d_config_particles["n_split"])
+# A single "track" value (None) is used when all the chunks are tracked in the same job
+if track_all_chunks_in_one_job:
+    track_array = [None]
+else:
+    track_array = np.arange(d_config_particles["n_split"])
 for idx_job, (track, qx, qy) in enumerate(itertools.product(track_array, array_qx, array_qy)):
     # If requested, ignore conditions below the upper diagonal as they can't be reached in the LHC
     if keep == "upper_triangle":
@@ -271,8 +364,13 @@ for idx_job, (track, qx, qy) in enumerate(itertools.product(track_array, array_q
         d_config_collider["config_knobs_and_tuning"]["qy"][beam] = float(qy)
 
     # Complete the dictionnary for the tracking
-    d_config_simulation["particle_file"] = f"../particles/{track:02}.parquet"
-    d_config_simulation["collider_file"] = "../collider.json.zip"
+    if track is None:
+        d_config_simulation["particle_file"] = "../particles"
+    else:
+        d_config_simulation["particle_file"] = f"../particles/{track:02}.parquet"
+    d_config_simulation["collider_file"] = (
+        "../collider.bin" if dump_collider_binary else "../collider.json.zip"
+    )
 
     # Add a child to the second generation, with all the parameters for the collider and tracking
     children["base_collider"]["children"][f"xtrack_{idx_job:04}"] = {
@@ -281,6 +379,10 @@ for idx_job, (track, qx, qy) in enumerate(itertools.product(track_array, array_q
         "log_file": "tree_maker.log",
         "dump_collider": dump_collider,
         "dump_config_in_collider": dump_config_in_collider,
+        "cache_configured_collider": cache_configured_collider,
+        "warm_start_matching": warm_start_matching,
+        "local_cache_dir": local_cache_dir,
+        "kernel_cache": kernel_cache_dir,
     }
 
 # ==================================================================================================
@@ -326,10 +428,41 @@ else:
 # Move to the folder that will contain the tree
 os.chdir(f"../scans/{study_name}")
 
-# Clean the id_job file
-id_job_file_path = "id_job.yaml"
-if os.path.isfile(id_job_file_path):
-    os.remove(id_job_file_path)
+# Clean the id_job files (registry and former yaml file)
+for id_job_file_path in ["id_job.yaml", "id_job.db", "id_job.db-wal", "id_job.db-shm"]:
+    if os.path.isfile(id_job_file_path):
+        os.remove(id_job_file_path)
+
+# Start a new status index, in which the jobs record their tags
+shutil.rmtree("status_index", ignore_errors=True)
+os.makedirs("status_index")
+status_index = os.path.abspath("status_index")
+children["base_collider"]["status_index"] = status_index
+for child in children["base_collider"]["children"].values():
+    child["status_index"] = status_index
+
+# If requested, the configurations of the jobs are recorded once in the config table of the
+# study, the outputs only keep their hash (entries are identified by their content, so the table
+# is not cleaned)
+if use_config_table:
+    os.makedirs("config_table", exist_ok=True)
+    for child in children["base_collider"]["children"].values():
+        child["config_table"] = os.path.abspath("config_table")
+
+# If requested, start a new results dataset, in which the jobs publish their outputs (a former
+# dataset is always removed, such that the postprocessing doesn't read outdated results)
+shutil.rmtree("results", ignore_errors=True)
+if use_results_dataset:
+    os.makedirs("results")
+    for child in children["base_collider"]["children"].values():
+        child["results_dataset"] = os.path.abspath("results")
+
+# The kernel cache is not cleaned when the study is created again (kernels only depend on the
+# elements of the line, and on the packages used to compile them)
+if kernel_cache_dir is not None and not kernel_cache_dir.startswith(("$", "~")):
+    os.makedirs(kernel_cache_dir, exist_ok=True)
+    for child in children["base_collider"]["children"].values():
+        child["kernel_cache"] = os.path.abspath(kernel_cache_dir)
 
 # Create tree object
 start_time = time.time()
@@ -3,6 +3,7 @@
 # ==================================================================================================
 # Standard library imports
 import copy
+import json
 import os
 import subprocess
 import time
@@ -11,14 +12,21 @@ from pathlib import Path
 # Third party imports
 import psutil
 import tree_maker
-import yaml
+
+# Local imports
+from job_registry import JobRegistry
+from local_scheduler import get_local_scheduler_jobs, submit_to_local_scheduler
+from pilot_worker import enqueue_jobs, get_pilot_jobs
+from status_index import StatusIndex, rebuild_status_index
 
 
 # ==================================================================================================
 # --- Class for job submission
 # ==================================================================================================
 class ClusterSubmission:
-    def __init__(self, config, path_root, singularity_image=None):
+    def __init__(
+        self, config, path_root, singularity_image=None, setup_env_script=None, status_index=None
+    ):
         # Configuration of the current generation
         self.config = config
         if config["run_on"] in ["local_pc", "htc", "slurm", "htc_docker", "slurm_docker"]:
@@ -39,9 +47,52 @@ class ClusterSubmission:
             self.request_GPUs = 0
             self.slurm_queue_statement = "#SBATCH --partition=slurm_hpc_acc"
 
-        # Path to store the association between job path and job id after submission
+        # Bulk submission (HTC only): a single submission stanza queuing all the jobs from a file of
+        # items, each job being mapped to its own cluster and process ids
+        self.bulk_submission = (
+            self.run_on in ["htc", "htc_docker"]
+            and "htc_bulk_submission" in config
+            and config["htc_bulk_submission"]
+        )
+
+        # Job array submission (SLURM only): the jobs are submitted as tasks of job arrays, each
+        # task getting its job folder from an index file
+        self.job_array = (
+            self.run_on in ["slurm", "slurm_docker"]
+            and "slurm_job_array" in config
+            and config["slurm_job_array"]
+        )
+
+        # Local scheduler (local_pc only): the jobs are run in a bounded pool of processes instead
+        # of being all started at once
+        self.local_scheduler = (
+            self.run_on == "local_pc" and "local_scheduler" in config and config["local_scheduler"]
+        )
+
+        # Pilot mode: the jobs are put in a queue, from which pilot_jobs pilot jobs (each running
+        # pilot_workers_per_job workers) pull them, such that the environment setup and imports are
+        # paid once per pilot instead of once per job
+        self.pilot_jobs = config["pilot_jobs"] if "pilot_jobs" in config else None
+        self.setup_env_script = setup_env_script
+
+        # Status of the nodes (read from the status index of the study if any, or from the logs)
+        self.status_index = status_index
+
+        # Time during which the state of the jobs on the cluster is reused, instead of querying it
+        # again (in seconds)
+        self.ttl_query_cache = config["query_cache_ttl"] if "query_cache_ttl" in config else 10
+        self._cache_cluster_jobs = None
+
+        # Registry storing the association between job path and job id after submission (the
+        # former id-job file is imported if present, and can still be exported on request)
         self.path_root = path_root
         self.path_dic_id_to_job = f"{self.path_root}/id_job.yaml"
+        path_registry = f"{self.path_root}/id_job.db"
+        registry_exists = os.path.isfile(path_registry)
+        self.job_registry = JobRegistry(path_registry)
+        if not registry_exists and os.path.isfile(self.path_dic_id_to_job):
+            self.job_registry.import_yaml(self.path_dic_id_to_job)
+        self.export_dic_id_to_job = "export_id_job_yaml" in config and config["export_id_job_yaml"]
 
         # Path to singularity image
         if singularity_image is not None:
@@ -69,8 +120,10 @@ class ClusterSubmission:
                     f" --error=error.txt --gres=gpu:{self.request_GPUs}"
                     f" {path_node}/run.sh\n"
                 ),
+                "body_array": "bash ./run.sh\n",
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"bash {filename}",
+                "submit_command_array": lambda filename: f"sbatch {filename}",
             },
             "slurm_docker": {
                 "head": lambda path_node: (
@@ -86,8 +139,10 @@ class ClusterSubmission:
                 "body": lambda path_node: (
                     f"singularity exec {self.path_image} {path_node}/run.sh\n"
                 ),
+                "body_array": f"singularity exec {self.path_image} ./run.sh\n",
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"sbatch {filename}",
+                "submit_command_array": lambda filename: f"sbatch {filename}",
             },
             "htc": {
                 "head": (
@@ -103,8 +158,16 @@ class ClusterSubmission:
                     + f'+JobFlavour  = "{job_flavour}"\n'
                     + "queue\n"
                 ),
+                "body_bulk": (
+                    lambda path_items, job_flavour: "executable = $(initialdir)/run.sh\n"
+                    + f"request_GPUs = {self.request_GPUs}\n"
+                    + f'+JobFlavour  = "{job_flavour}"\n'
+                    + f"queue initialdir from {path_items}\n"
+                ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"condor_submit {filename}",
+                "submit_command_bulk": lambda filename: f"condor_submit -terse {filename}",
+                "submit_command_dag": lambda filename: f"condor_submit_dag -force {filename}",
             },
             "htc_docker": {
                 "head": (
@@ -123,45 +186,32 @@ class ClusterSubmission:
                     + f'+JobFlavour  = "{job_flavour}"\n'
                     + "queue\n"
                 ),
+                "body_bulk": (
+                    lambda path_items, job_flavour: "executable = $(initialdir)/run.sh\n"
+                    + f"request_GPUs = {self.request_GPUs}\n"
+                    + f'+JobFlavour  = "{job_flavour}"\n'
+                    + f"queue initialdir from {path_items}\n"
+                ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"condor_submit {filename}",
+                "submit_command_bulk": lambda filename: f"condor_submit -terse {filename}",
+                "submit_command_dag": lambda filename: f"condor_submit_dag -force {filename}",
             },
         }
 
-    # Getter for dic_id_to_job
+    # Getter for dic_id_to_job (jobs still active only)
     @property
     def dic_id_to_job(self):
-        if os.path.isfile(self.path_dic_id_to_job):
-            with open(self.path_dic_id_to_job, "r") as fid:
-                return yaml.load(fid, Loader=yaml.FullLoader)
+        if self.job_registry.has_submissions():
+            return self.job_registry.get_dic_id_to_job()
         else:
             return None
 
-    # Setter for dic_id_to_job
-    @dic_id_to_job.setter
-    def dic_id_to_job(self, dic_id_to_job):
-        assert isinstance(dic_id_to_job, dict)
-        # Ensure all ids are integers
-        dic_id_to_job = {int(id_job): job for id_job, job in dic_id_to_job.items()}
-
-        # Write on disk
-        with open(self.path_dic_id_to_job, "w") as fid:
-            yaml.dump(dic_id_to_job, fid)
-
-        # Wait 0.5s to make sure the file is written on disk
-        time.sleep(0.5)
-
     def _update_dic_id_to_job(self, running_jobs, queuing_jobs):
-        # Look for jobs in the dictionnary that are not running or queuing anymore
-        dic_id_to_job = self.dic_id_to_job
-        set_current_jobs = set(running_jobs + queuing_jobs)
-        if dic_id_to_job is not None:
-            for id_job, job in self.dic_id_to_job.items():
-                if job not in set_current_jobs:
-                    del dic_id_to_job[id_job]
-
-            # Update (write on disk) dic_id_to_job
-            self.dic_id_to_job = dic_id_to_job
+        # Jobs in the registry that are not running or queuing anymore are tagged as finished
+        self.job_registry.update_states(running_jobs, queuing_jobs)
+        if self.export_dic_id_to_job:
+            self.job_registry.export_yaml(self.path_dic_id_to_job)
 
     def _get_state_jobs(self, dic_id_to_job=None, verbose=True):
         if dic_id_to_job is None:
@@ -187,10 +237,9 @@ class ClusterSubmission:
 
         return path_job
 
-    @staticmethod
-    def _test_node(node, path_job, running_jobs, queuing_jobs):
+    def _test_node(self, node, path_job, running_jobs, queuing_jobs):
         # Test if node is running, queuing or completed
-        if node.has_been("completed"):
+        if has_been(node, "completed", self.status_index):
             print(f"{path_job} is already completed.")
         elif path_job in running_jobs:
             print(f"{path_job} is already running.")
@@ -217,7 +266,8 @@ class ClusterSubmission:
                 # Write the submission files
                 print(f'Writing submission file for node "{path_node}"')
                 with open(filename_node, "w") as fid:
-                    # Careful, I implemented a fix for path due to the temporary home recovery folder
+                    # Careful, I implemented a fix for path due to the temporary home recovery
+                    # folder
                     to_replace = "/storage-hpc/gpfs_data/HPC/home_recovery"
                     replacement = "/home/HPC"
                     fixed_path = path_node.replace(to_replace, replacement)
@@ -250,6 +300,20 @@ class ClusterSubmission:
         str_body = self.dic_submission[self.run_on]["body"]
         str_tail = self.dic_submission[self.run_on]["tail"]
 
+        # Get job flavour (for HTC)
+        job_flavour = None
+        if self.run_on in ["htc", "htc_docker"] and "htc_job_flavor" in self.config:
+            job_flavour = self.config["htc_job_flavor"]
+        elif self.run_on in ["htc", "htc_docker"]:
+            print("Warning: htc_job_flavor not defined in config.yaml. Using espresso as default")
+            job_flavour = "espresso"
+
+        # Bulk submission is a peculiar case as a single stanza is written for all the jobs
+        if self.bulk_submission:
+            return self._write_sub_file_bulk(
+                filename, running_jobs, queuing_jobs, list_of_nodes, job_flavour
+            )
+
         # Flag to know if the file can be submitted (at least one job in it)
         ok_to_submit = False
 
@@ -270,14 +334,8 @@ class ClusterSubmission:
                 if self._test_node(node, path_job, running_jobs, queuing_jobs):
                     print(f'Writing submission command for node "{path_node}"')
                     # Write instruction for submission
-                    if self.run_on in ["htc", "htc_docker"] and "htc_job_flavor" in self.config:
-                        fid.write(str_body(path_node, self.config["htc_job_flavor"]))
-                    elif self.run_on in ["htc", "htc_docker"]:
-                        print(
-                            "Warning: htc_job_flavor not defined in config.yaml. Using espresso as"
-                            " default"
-                        )
-                        fid.write(str_body(path_node, "espresso"))
+                    if job_flavour is not None:
+                        fid.write(str_body(path_node, job_flavour))
                     else:
                         fid.write(str_body(path_node))
 
@@ -295,7 +353,250 @@ class ClusterSubmission:
 
         return ([filename], l_path_jobs) if ok_to_submit else ([], [])
 
+    def _write_sub_file_bulk(
+        self, filename, running_jobs, queuing_jobs, list_of_nodes, job_flavour
+    ):
+        # Get the jobs to submit
+        l_path_nodes = []
+        l_path_jobs = []
+        for node in list_of_nodes:
+            path_node = node.get_abs_path()
+            path_job = self._get_path_job(path_node)
+            if self._test_node(node, path_job, running_jobs, queuing_jobs):
+                l_path_nodes.append(path_node)
+                l_path_jobs.append(path_job)
+
+        if len(l_path_jobs) == 0:
+            return [], []
+
+        # Write the items file, one job folder per line (the process id of each job is its index)
+        path_items = f"{filename.split('.sub')[0]}_items.txt"
+        with open(path_items, "w") as fid:
+            fid.write("\n".join(l_path_nodes) + "\n")
+        print(f"Writing bulk submission for {len(l_path_jobs)} jobs")
+
+        # Write the submission file
+        with open(filename, "w") as fid:
+            fid.write(self.dic_submission[self.run_on]["head"])
+            fid.write(
+                self.dic_submission[self.run_on]["body_bulk"](
+                    os.path.abspath(path_items), job_flavour
+                )
+            )
+            fid.write(self.dic_submission[self.run_on]["tail"])
+
+        return [filename], l_path_jobs
+
+    def _write_sub_files_slurm_array(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+        # Get the jobs to submit
+        l_path_nodes = []
+        l_path_jobs = []
+        for node in list_of_nodes:
+            path_node = node.get_abs_path()
+            path_job = self._get_path_job(path_node)
+            if self._test_node(node, path_job, running_jobs, queuing_jobs):
+                # Same fix for path as for the individual SLURM submission files
+                l_path_nodes.append(
+                    path_node.replace("/storage-hpc/gpfs_data/HPC/home_recovery", "/home/HPC")
+                )
+                l_path_jobs.append(path_job)
+
+        # Split the jobs in several arrays if needed (arrays are limited by MaxArraySize)
+        max_array_size = (
+            self.config["slurm_max_array_size"] if "slurm_max_array_size" in self.config else 1000
+        )
+        max_concurrent = (
+            f"%{self.config['slurm_max_concurrent_jobs']}"
+            if "slurm_max_concurrent_jobs" in self.config
+            and self.config["slurm_max_concurrent_jobs"]
+            else ""
+        )
+
+        l_filenames = []
+        for idx_array, idx_first in enumerate(range(0, len(l_path_nodes), max_array_size)):
+            l_path_nodes_array = l_path_nodes[idx_first : idx_first + max_array_size]
+            filename_array = f"{filename.split('.sub')[0]}_array_{idx_array}.sub"
+
+            # Write the index file, the task id of each job is its line number (starting from 0)
+            path_index = os.path.abspath(f"{filename.split('.sub')[0]}_array_{idx_array}.txt")
+            with open(path_index, "w") as fid:
+                fid.write("\n".join(l_path_nodes_array) + "\n")
+
+            # Write the array submission file
+            print(f"Writing job array submission file for {len(l_path_nodes_array)} jobs")
+            with open(filename_array, "w") as fid:
+                fid.write(
+                    "#!/bin/bash\n"
+                    + "# This is a SLURM job array submission file\n"
+                    + self.slurm_queue_statement
+                    + "\n"
+                    + f"#SBATCH --array=0-{len(l_path_nodes_array) - 1}{max_concurrent}\n"
+                    + "#SBATCH --output=/dev/null\n"
+                    + "#SBATCH --error=/dev/null\n"
+                    + "#SBATCH --ntasks=2\n"
+                    + f"#SBATCH --gres=gpu:{self.request_GPUs}\n"
+                )
+
+                # Get the job folder of the task, and redirect the outputs there
+                fid.write(
+                    f'path_node=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {path_index})\n'
+                    + "cd $path_node\n"
+                    + "exec > output.txt 2> error.txt\n"
+                )
+
+                # Body
+                fid.write(self.dic_submission[self.run_on]["body_array"])
+
+                # Tail
+                fid.write(self.dic_submission[self.run_on]["tail"])
+
+            l_filenames.append(filename_array)
+
+        return l_filenames, l_path_jobs
+
+    def _get_local_scheduler_options(self):
+        dic_defaults = {
+            "local_max_jobs": ("n_workers", None),
+            "local_memory_per_job_gb": ("memory_per_job_gb", None),
+            "local_queue_policy": ("policy", "fifo"),
+            "local_scheduler_detach": ("detach", True),
+        }
+        return {
+            name: self.config[key] if key in self.config else default
+            for key, (name, default) in dic_defaults.items()
+        }
+
+    def _write_sub_file_local_scheduler(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+        # Priority of the jobs (only used with the priority policy)
+        priority = self.config["local_priority"] if "local_priority" in self.config else 0
+
+        # The submission file is the list of jobs to queue, one json list [priority, path_node,
+        # path_job] per line (paths may contain spaces)
+        l_path_jobs = []
+        with open(filename, "w") as fid:
+            for node in list_of_nodes:
+                path_node = node.get_abs_path()
+                path_job = self._get_path_job(path_node)
+                if self._test_node(node, path_job, running_jobs, queuing_jobs):
+                    print(f'Queuing node "{path_node}"')
+                    fid.write(json.dumps([priority, path_node, path_job]) + "\n")
+                    l_path_jobs.append(path_job)
+
+        if len(l_path_jobs) == 0:
+            os.remove(filename)
+            return [], []
+        return [filename], l_path_jobs
+
+    def _write_sub_file_pilot(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+        # Put the jobs in the queue
+        l_path_nodes = []
+        l_path_jobs = []
+        for node in list_of_nodes:
+            path_node = node.get_abs_path()
+            path_job = self._get_path_job(path_node)
+            if self._test_node(node, path_job, running_jobs, queuing_jobs):
+                l_path_nodes.append(path_node)
+                l_path_jobs.append(path_job)
+        enqueue_jobs(self.path_root, l_path_nodes, l_path_jobs)
+
+        # Pilots are needed as long as jobs are waiting in the queue (pilots in excess exit as soon
+        # as the queue is empty)
+        if not get_pilot_jobs(self.path_root, "queuing"):
+            return [], []
+        pack_size = (
+            self.config["pilot_pack_size"]
+            if "pilot_pack_size" in self.config and self.config["pilot_pack_size"]
+            else 1
+        )
+        n_pilots = min(
+            self.pilot_jobs, -(-len(get_pilot_jobs(self.path_root, "queuing")) // pack_size)
+        )
+        print(f"Writing submission file for {n_pilots} pilot jobs")
+
+        # Script run by each pilot
+        path_pilot = f"{self.path_root}/pilot_queue"
+        l_options = [
+            f"--n-workers {self.config['pilot_workers_per_job']}"
+            if "pilot_workers_per_job" in self.config and self.config["pilot_workers_per_job"]
+            else "",
+            "--in-process"
+            if "pilot_in_process" in self.config and self.config["pilot_in_process"]
+            else "",
+            f"--max-time {self.config['pilot_max_time']}"
+            if "pilot_max_time" in self.config and self.config["pilot_max_time"]
+            else "",
+            f"--pack-size {self.config['pilot_pack_size']}"
+            if "pilot_pack_size" in self.config and self.config["pilot_pack_size"]
+            else "",
+        ]
+        with open(f"{path_pilot}/run_pilot.sh", "w") as fid:
+            fid.write(
+                "#!/bin/bash\n"
+                + (f"source {self.setup_env_script}\n" if self.setup_env_script else "")
+                + f"python {Path(__file__).resolve().parent / 'pilot_worker.py'} {self.path_root}"
+                + f" {self.config['job_executable']} {' '.join(l_options)}\n"
+            )
+        os.chmod(f"{path_pilot}/run_pilot.sh", 0o755)
+
+        # Submission file of the pilots, outputs are written in the queue folder
+        with open(filename, "w") as fid:
+            if self.run_on == "local_pc":
+                for idx_pilot in range(n_pilots):
+                    fid.write(
+                        f"bash {path_pilot}/run_pilot.sh > {path_pilot}/output_{idx_pilot}.txt"
+                        f" 2> {path_pilot}/error_{idx_pilot}.txt &\n"
+                    )
+            elif self.run_on in ["htc", "htc_docker"]:
+                job_flavour = (
+                    self.config["htc_job_flavor"] if "htc_job_flavor" in self.config else "espresso"
+                )
+                fid.write(
+                    self.dic_submission[self.run_on]["head"]
+                    + "error  = error_$(Process).txt\n"
+                    + "output = output_$(Process).txt\n"
+                    + f"initialdir = {path_pilot}\n"
+                    + f"executable = {path_pilot}/run_pilot.sh\n"
+                    + f"request_GPUs = {self.request_GPUs}\n"
+                    + f'+JobFlavour  = "{job_flavour}"\n'
+                    + f"queue {n_pilots}\n"
+                )
+            else:
+                fid.write(
+                    "#!/bin/bash\n"
+                    + "# This is a SLURM submission file for pilot jobs\n"
+                    + self.slurm_queue_statement
+                    + "\n"
+                    + f"#SBATCH --array=0-{n_pilots - 1}\n"
+                    + f"#SBATCH --output={path_pilot}/output_%a.txt\n"
+                    + f"#SBATCH --error={path_pilot}/error_%a.txt\n"
+                    + "#SBATCH --ntasks=2\n"
+                    + f"#SBATCH --gres=gpu:{self.request_GPUs}\n"
+                    + (
+                        f"singularity exec {self.path_image} {path_pilot}/run_pilot.sh\n"
+                        if self.run_on == "slurm_docker"
+                        else f"bash {path_pilot}/run_pilot.sh\n"
+                    )
+                )
+
+        return [filename], l_path_jobs
+
     def _write_sub_files(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+        # The pilots pull the jobs from a queue
+        if self.pilot_jobs:
+            return self._write_sub_file_pilot(filename, running_jobs, queuing_jobs, list_of_nodes)
+
+        # The local scheduler gets the list of jobs to run
+        if self.local_scheduler:
+            return self._write_sub_file_local_scheduler(
+                filename, running_jobs, queuing_jobs, list_of_nodes
+            )
+
+        # Job arrays are written for SLURM if requested
+        if self.job_array:
+            return self._write_sub_files_slurm_array(
+                filename, running_jobs, queuing_jobs, list_of_nodes
+            )
+
         # Slurm docker is a peculiar case as one submission file must be created per job
         if self.run_on == "slurm_docker":
             return self._write_sub_files_slurm(filename, running_jobs, queuing_jobs, list_of_nodes)
@@ -316,9 +617,9 @@ class ClusterSubmission:
         )
         return l_filenames, l_path_jobs
 
-    def submit(self, l_filenames, l_jobs):
+    def submit(self, l_filenames, l_jobs, dependency=None, print_status=True):
         # Check that the submission file(s) is/are appropriate for the submission mode
-        if len(l_filenames) > 1 and self.run_on != "slurm_docker":
+        if len(l_filenames) > 1 and self.run_on != "slurm_docker" and not self.job_array:
             raise (
                 "Error: Multiple submission files should not be implemented for this submission"
                 " mode"
@@ -326,28 +627,75 @@ class ClusterSubmission:
         if len(l_filenames) == 0:
             print("No job being submitted.")
 
+        # The jobs only start once the job they depend on has completed successfully (SLURM only)
+        env = os.environ.copy()
+        if dependency is not None and "slurm" in self.run_on:
+            env["SBATCH_DEPENDENCY"] = f"afterok:{dependency}"
+
         # Submit
         dic_id_to_job_temp = {}
         idx_submission = 0
         for filename in l_filenames:
             if self.run_on in self.dic_submission:
-                if self.run_on == "local_pc":
+                if self.pilot_jobs:
+                    # The pilots are not jobs of the study, they are not recorded
+                    if self.run_on == "local_pc":
+                        os.system(f"bash {filename}")
+                    elif "htc" in self.run_on:
+                        os.system(f"condor_submit {filename}")
+                    else:
+                        os.system(f"sbatch {filename}")
+                elif self.local_scheduler:
+                    with open(filename, "r") as fid:
+                        l_jobs_scheduler = [json.loads(line) for line in fid.read().splitlines()]
+                    submit_to_local_scheduler(
+                        self.path_root, l_jobs_scheduler, **self._get_local_scheduler_options()
+                    )
+                elif self.run_on == "local_pc":
                     os.system(self.dic_submission[self.run_on]["submit_command"](filename))
                 else:
+                    if self.bulk_submission:
+                        submit_command = self.dic_submission[self.run_on]["submit_command_bulk"]
+                    elif self.job_array:
+                        submit_command = self.dic_submission[self.run_on]["submit_command_array"]
+                    else:
+                        submit_command = self.dic_submission[self.run_on]["submit_command"]
                     process = subprocess.run(
-                        self.dic_submission[self.run_on]["submit_command"](filename).split(" "),
+                        submit_command(filename).split(" "),
                         capture_output=True,
+                        env=env,
                     )
                     output = process.stdout.decode("utf-8")
                     output_error = process.stderr.decode("utf-8")
                     if "ERROR" in output_error:
                         raise RuntimeError(f"Error in submission: {output_error}")
                     for line in output.split("\n"):
-                        if "htc" in self.run_on:
+                        if self.bulk_submission:
+                            # Terse output: "cluster.first_proc - cluster.last_proc"
+                            if " - " in line:
+                                first_id, last_id = line.strip().split(" - ")
+                                cluster_id, first_proc = first_id.split(".")
+                                last_proc = last_id.split(".")[1]
+                                for proc_id in range(int(first_proc), int(last_proc) + 1):
+                                    job = l_jobs[idx_submission]
+                                    dic_id_to_job_temp[f"{cluster_id}.{proc_id}"] = job
+                                    idx_submission += 1
+                        elif "htc" in self.run_on:
                             if "cluster" in line:
                                 cluster_id = int(line.split("cluster ")[1][:-1])
                                 dic_id_to_job_temp[cluster_id] = l_jobs[idx_submission]
                                 idx_submission += 1
+                        elif self.job_array:
+                            # Each task of the array is identified as "job_task"
+                            if "Submitted" in line:
+                                job_id = int(line.split(" ")[3])
+                                with open(filename.replace(".sub", ".txt"), "r") as fid:
+                                    n_tasks = len(fid.read().splitlines())
+                                for task_id in range(n_tasks):
+                                    dic_id_to_job_temp[f"{job_id}_{task_id}"] = l_jobs[
+                                        idx_submission
+                                    ]
+                                    idx_submission += 1
                         elif "slurm" in self.run_on:
                             if "Submitted" in line:
                                 job_id = int(line.split(" ")[3])
@@ -356,23 +704,48 @@ class ClusterSubmission:
             else:
                 raise ValueError(f"Error: Submission mode {self.run_on} is not yet implemented")
 
-        # Update and write the id-job file
+        # The state of the jobs has changed
+        self._invalidate_cache_cluster_jobs()
+
+        # Record the submitted jobs in the registry
         if dic_id_to_job_temp:
             assert len(dic_id_to_job_temp) == len(l_jobs)
+            self.job_registry.add_jobs(dic_id_to_job_temp, self.run_on, ", ".join(l_filenames))
 
-        # Merge with the previous id-job file
-        dic_id_to_job = self.dic_id_to_job
+        if print_status:
+            print("Jobs status after submission:")
+            self._get_state_jobs(verbose=True)
 
-        # Update and write on disk
-        if dic_id_to_job is not None:
-            dic_id_to_job.update(dic_id_to_job_temp)
-            self.dic_id_to_job = dic_id_to_job
-        elif dic_id_to_job_temp:
-            dic_id_to_job = dic_id_to_job_temp
-            self.dic_id_to_job = dic_id_to_job
+        return dic_id_to_job_temp
 
-        print("Jobs status after submission:")
-        running_jobs, queuing_jobs = self._get_state_jobs(dic_id_to_job=dic_id_to_job, verbose=True)
+    def submit_dag(self, filename, l_dag_nodes):
+        # Submit a DAG (HTCondor only), l_dag_nodes being a list of (name of the node, submission
+        # file, list of jobs, name of the parent node or None)
+        with open(filename, "w") as fid:
+            for name, filename_node, _, _ in l_dag_nodes:
+                fid.write(f"JOB {name} {os.path.abspath(filename_node)}\n")
+            for name, _, _, name_parent in l_dag_nodes:
+                if name_parent is not None:
+                    fid.write(f"PARENT {name_parent} CHILD {name}\n")
+
+        process = subprocess.run(
+            self.dic_submission[self.run_on]["submit_command_dag"](filename).split(" "),
+            capture_output=True,
+        )
+        output = process.stdout.decode("utf-8")
+        output_error = process.stderr.decode("utf-8")
+        if "ERROR" in output_error or "cluster" not in output:
+            raise RuntimeError(f"Error in DAG submission: {output_error}")
+        cluster_id = int(output.split("cluster ")[1].split(".")[0])
+
+        # The jobs of the DAG get their own ids only once the DAG submits them, they are identified
+        # by the cluster id of the DAG in the meantime
+        l_jobs = [job for _, _, l_jobs_node, _ in l_dag_nodes for job in l_jobs_node]
+        self.job_registry.add_jobs(
+            {f"{cluster_id}.dag{idx}": job for idx, job in enumerate(l_jobs)}, self.run_on, filename
+        )
+        self._invalidate_cache_cluster_jobs()
+        print(f"DAG of {len(l_jobs)} jobs submitted to cluster {cluster_id}")
 
     @staticmethod
     def _get_local_jobs():
@@ -389,87 +762,167 @@ class ClusterSubmission:
                 # Only get path after studies
                 job = job.split("studies")[1]
 
-                l_jobs.append(f"{job}/")
+                l_jobs.append((None, "running", f"{job}/"))
         return l_jobs
 
     @staticmethod
-    def _get_condor_jobs(status, dic_id_to_job=None, force_query_individually=False):
-        l_jobs = []
-        dic_status = {"running": 1, "queuing": 2}
-        condor_output = subprocess.run(["condor_q"], capture_output=True).stdout.decode("utf-8")
+    def _get_path_job_from_command(command, jobid=None):
+        # Command is either the run.sh script of the job, or a submission file
+        if "run.sh" in command:
+            job = command.split("run.sh")[0]
+        elif os.path.isfile(command.replace(".sub", ".txt")) and "_" in str(jobid):
+            # Tasks of job arrays get their job folder from the index file of the array
+            with open(command.replace(".sub", ".txt"), "r") as fid:
+                job = fid.read().splitlines()[int(str(jobid).split("_")[1])] + "/"
+        elif command.endswith(".sub") and os.path.isfile(command):
+            # Individual SLURM submission files redirect the output to the job folder
+            with open(command, "r") as fid:
+                content = fid.read()
+            if "--output=" not in content:
+                return None
+            job = content.split("--output=")[1].split("output.txt")[0]
+        else:
+            return None
 
-        # Check which jobs are running
-        first_line = True
-        first_missing_job = True
-        for line in condor_output.split("\n")[4:]:
-            if line == "":
-                break
-            jobid = int(line.split("ID:")[1][1:8])
-            condor_status = line.split("      ")[1:5]  # Done, Run, Idle, and potentially Hold
-
-            # If job is running/queuing, get the path to the job
-            if condor_status[dic_status[status]] == "1":
-                # Get path from dic_id_to_job if available
-                if dic_id_to_job is not None:
-                    if jobid in dic_id_to_job:
-                        l_jobs.append(dic_id_to_job[jobid])
-                    elif first_missing_job:
-                        print(
-                            "Warning, some jobs are queuing/running and are not in the id-job"
-                            " file. They may come from another study. Ignoring them."
-                        )
-                        first_missing_job = False
-
-                elif force_query_individually:
-                    if first_line:
-                        print(
-                            "Warning, some jobs are queuing/running and the id-job file is"
-                            " missing... Querying them individually."
-                        )
-                        first_line = False
-                    job_details = subprocess.run(
-                        ["condor_q", "-l", f"{jobid}"], capture_output=True
-                    ).stdout.decode("utf-8")
-                    job = job_details.split('Cmd = "')[1].split("run.sh")[0]
-
-                    # Only get path after studies
-                    job = job.split("studies")[1]
-                    l_jobs.append(job)
-
-                elif first_line:
-                    print(
-                        "Warning, some jobs are queuing/running and the id-job file is"
-                        " missing... Ignoring them."
-                    )
-                    first_line = False
+        # Only get path after studies
+        return job.split("studies")[1] if "studies" in job else None
 
-        return l_jobs
+    def _get_condor_jobs(self):
+        dic_status = {"2": "running", "1": "queuing"}
+        # One line per job: "cluster.proc status command"
+        condor_output = subprocess.run(
+            ["condor_q", "-af:j", "JobStatus", "Cmd"], capture_output=True
+        ).stdout.decode("utf-8")
 
-    @staticmethod
-    def _get_slurm_jobs(status, dic_id_to_job=None, force_query_individually=False):
         l_jobs = []
-        dic_status = {"running": "RUNNING", "queuing": "PENDING"}
+        for line in condor_output.split("\n"):
+            l_split = line.split()
+            if len(l_split) < 3 or l_split[1] not in dic_status:
+                continue
+            jobid, condor_status, cmd = l_split[:3]
+            l_jobs.append((jobid, dic_status[condor_status], self._get_path_job_from_command(cmd)))
+        return l_jobs
+
+    def _get_slurm_jobs(self):
+        dic_status = {"RUNNING": "running", "PENDING": "queuing"}
         username = (
             subprocess.run(["id", "-u", "-n"], capture_output=True).stdout.decode("utf-8").strip()
         )
+        # One line per job: "id state command" (tasks of job arrays are listed individually, as
+        # "job_task")
         slurm_output = subprocess.run(
-            ["squeue", "-u", f"{username}", "-t", dic_status[status]], capture_output=True
+            ["squeue", "-r", "-h", "-u", username, "-t", "RUNNING,PENDING", "-o", "%i %T %o"],
+            capture_output=True,
         ).stdout.decode("utf-8")
 
-        # Get job id and details
+        l_jobs = []
+        for line in slurm_output.split("\n"):
+            l_split = line.split()
+            if len(l_split) < 3 or l_split[1] not in dic_status:
+                continue
+            jobid, slurm_status, command = l_split[:3]
+            jobid = int(jobid) if jobid.isdigit() else jobid
+            l_jobs.append(
+                (jobid, dic_status[slurm_status], self._get_path_job_from_command(command, jobid))
+            )
+        return l_jobs
+
+    def _get_cluster_jobs(self):
+        # A single query gives all the jobs (id, state and path), cached for a short time since it
+        # is needed several times per submission
+        if (
+            self._cache_cluster_jobs is not None
+            and time.time() - self._cache_cluster_jobs[0] < self.ttl_query_cache
+        ):
+            return self._cache_cluster_jobs[1]
+
+        if self.pilot_jobs:
+            # State of the jobs in the queue of the pilots
+            l_jobs = [
+                (None, status, job)
+                for status in ["running", "queuing"]
+                for job in get_pilot_jobs(self.path_root, status)
+            ]
+        elif self.local_scheduler:
+            # State of the jobs tracked by the scheduler itself
+            l_jobs = [
+                (None, status, job)
+                for status in ["running", "queuing"]
+                for job in get_local_scheduler_jobs(self.path_root, status)
+            ]
+        elif self.run_on == "local_pc":
+            l_jobs = self._get_local_jobs()
+        elif self.run_on in ["htc", "htc_docker"]:
+            l_jobs = self._get_condor_jobs()
+        elif self.run_on in ["slurm", "slurm_docker"]:
+            l_jobs = self._get_slurm_jobs()
+        else:
+            print("Querying jobs are not implemented yet for this submission mode")
+            l_jobs = []
+
+        self._cache_cluster_jobs = (time.time(), l_jobs)
+        return l_jobs
+
+    def _invalidate_cache_cluster_jobs(self):
+        self._cache_cluster_jobs = None
+
+    def querying_jobs(
+        self, status="running", dic_id_to_job=None, force_query_individually=False
+    ):
+        l_jobs = []
         first_line = True
         first_missing_job = True
-        for line in slurm_output.split("\n")[1:]:
-            l_split = line.split()
-            if len(l_split) == 0:
-                break
-            jobid = int(l_split[0])
-            slurm_status = l_split[4]  # R or PD
+        l_cluster_jobs = self._get_cluster_jobs()
+
+        # Jobs submitted through a DAG are identified by the cluster id of the DAG, and by their
+        # path once the DAG has submitted them. The others are queuing as long as the DAG runs
+        dic_dag_to_jobs = {}
+        if dic_id_to_job is not None:
+            for id_job, job in dic_id_to_job.items():
+                if isinstance(id_job, str) and ".dag" in id_job:
+                    dic_dag_to_jobs.setdefault(int(id_job.split(".")[0]), []).append(job)
+        set_dag_jobs = {job for l_jobs_dag in dic_dag_to_jobs.values() for job in l_jobs_dag}
+        l_ids_dag = [
+            jobid
+            for jobid, _, _ in l_cluster_jobs
+            if isinstance(jobid, str)
+            and "." in jobid
+            and int(jobid.split(".")[0]) in dic_dag_to_jobs
+        ]
+        if status == "queuing":
+            set_jobs_submitted = {path_job for _, _, path_job in l_cluster_jobs}
+            for jobid in l_ids_dag:
+                l_jobs.extend(
+                    job
+                    for job in dic_dag_to_jobs[int(jobid.split(".")[0])]
+                    if job not in set_jobs_submitted
+                )
 
-            # Get path from dic_id_to_job if available
-            if dic_id_to_job is not None:
+        for jobid, status_job, path_job in l_cluster_jobs:
+            if status_job != status:
+                continue
+
+            # Local jobs are identified by their path only
+            if jobid is None:
+                l_jobs.append(path_job)
+
+            # The DAG jobs themselves are not jobs of the study
+            elif jobid in l_ids_dag:
+                continue
+
+            # Get path from dic_id_to_job if available (HTC jobs submitted in bulk are identified
+            # by their cluster and process ids, the others by their cluster id only)
+            elif dic_id_to_job is not None:
                 if jobid in dic_id_to_job:
                     l_jobs.append(dic_id_to_job[jobid])
+                elif (
+                    isinstance(jobid, str)
+                    and "." in jobid
+                    and int(jobid.split(".")[0]) in dic_id_to_job
+                ):
+                    l_jobs.append(dic_id_to_job[int(jobid.split(".")[0])])
+                elif path_job in set_dag_jobs:
+                    l_jobs.append(path_job)
                 elif first_missing_job:
                     print(
                         "Warning, some jobs are queuing/running and are not in the id-job"
@@ -477,24 +930,16 @@ class ClusterSubmission:
                     )
                     first_missing_job = False
 
+            # Otherwise, use the path obtained from the command of the job
             elif force_query_individually:
                 if first_line:
                     print(
                         "Warning, some jobs are queuing/running and the id-job file is"
-                        " missing... Querying them individually."
+                        " missing... Getting their path from their command."
                     )
                     first_line = False
-                job_details = subprocess.run(
-                    ["scontrol", "show", "jobid", "-dd", f"{jobid}"], capture_output=True
-                ).stdout.decode("utf-8")
-                job = (
-                    job_details.split("Command=")[1].split("run.sh")[0]
-                    if "run.sh" in job_details
-                    else job_details.split("StdOut=")[1].split("output.txt")[0]
-                )
-                # Only get path after studies
-                job = job.split("studies")[1]
-                l_jobs.append(job)
+                if path_job is not None:
+                    l_jobs.append(path_job)
 
             elif first_line:
                 print(
@@ -505,83 +950,208 @@ class ClusterSubmission:
 
         return l_jobs
 
-    def querying_jobs(self, status="running", dic_id_to_job=None):
-        l_jobs = []
 
-        if self.run_on == "local_pc":
-            if status == "running":
-                l_jobs = self._get_local_jobs()
-        elif self.run_on in ["htc", "htc_docker"]:
-            l_jobs = self._get_condor_jobs(status, dic_id_to_job)
+# ==================================================================================================
+# --- Functions to get the status of the nodes
+# ==================================================================================================
+def get_status_index(root, rebuild=False):
+    # Studies created before the status index have none, their nodes' logs are read instead
+    path_index = f"{root.get_abs_path()}/status_index"
+    if rebuild:
+        print("Rebuilding the status index from the logs of the nodes")
+        rebuild_status_index(path_index, root.descendants)
+    return StatusIndex(path_index) if os.path.isdir(path_index) else None
 
-        elif self.run_on in ["slurm", "slurm_docker"]:
-            l_jobs = self._get_slurm_jobs(status, dic_id_to_job)
 
-        else:
-            print("Querying jobs are not implemented yet for this submission mode")
-        return l_jobs
+def has_been(node, tag, status_index=None):
+    if status_index is None:
+        return node.has_been(tag)
+    return status_index.has_been(node.get_abs_path(), tag)
 
 
 # ==================================================================================================
 # --- Main submission function
 # ==================================================================================================
-def submit_jobs_generation(root, generation=1):
-    # Define a dictionnary that associates a name to each generation number
-    dic_int_to_str = {1: "first", 2: "second", 3: "third", 4: "fourth", 5: "fifth"}
+# Define a dictionnary that associates a name to each generation number
+dic_int_to_str = {1: "first", 2: "second", 3: "third", 4: "fourth", 5: "fifth"}
+
+
+def submit_jobs_generation(root, generation=1, list_of_nodes=None, status_index=None):
     if generation not in dic_int_to_str:
         raise ValueError(f"Error: Generation {generation} is not implemented")
 
-    # Submit all the pending jobs of a given generation
+    # Submit all the pending jobs of a given generation (or of the given nodes of the generation)
+    if list_of_nodes is None:
+        list_of_nodes = root.generation(generation)
     config_generation = root.parameters["generations"][f"{generation}"]
     singularity_image = root.parameters["singularity_image"]
     cluster_submission = ClusterSubmission(
-        config_generation, root.get_abs_path(), singularity_image
+        config_generation,
+        root.get_abs_path(),
+        singularity_image,
+        root.parameters["setup_env_script"],
+        status_index,
     )
     path_file = f"../submission_files/{dic_int_to_str[generation]}_generation.sub"
-    l_filenames, l_path_jobs = cluster_submission.write_sub_files(
-        root.generation(generation), path_file
-    )
+    l_filenames, l_path_jobs = cluster_submission.write_sub_files(list_of_nodes, path_file)
     cluster_submission.submit(l_filenames, l_path_jobs)
 
 
-def submit_jobs(study_name, print_uncompleted_jobs=False):
+def submit_jobs_per_parent(root, status_index=None):
+    # Submit the pending jobs of generation 1, and the pending jobs of generation 2 whose parent
+    # is completed (the others are submitted at the next call)
+    if not all(has_been(node, "completed", status_index) for node in root.generation(1)):
+        print("######## Taking care of generation 1 ########")
+        submit_jobs_generation(root, generation=1, status_index=status_index)
+    else:
+        print("Generation 1 is already completed.")
+
+    list_of_nodes = [
+        node_child
+        for node in root.generation(1)
+        if has_been(node, "completed", status_index)
+        for node_child in node.children
+    ]
+    if not list_of_nodes:
+        return
+    if not all(has_been(node, "completed", status_index) for node in root.generation(2)):
+        print("######## Taking care of generation 2 ########")
+        submit_jobs_generation(
+            root, generation=2, list_of_nodes=list_of_nodes, status_index=status_index
+        )
+    else:
+        print("Generation 2 is already completed.")
+
+
+def submit_jobs_with_dependencies(root, status_index=None):
+    # Generation 2 jobs are submitted along with their generation 1 parent, and start as soon as
+    # their own parent has completed successfully (SLURM dependencies, or HTCondor DAG)
+    singularity_image = root.parameters["singularity_image"]
+    setup_env_script = root.parameters["setup_env_script"]
+    cs_1 = ClusterSubmission(
+        root.parameters["generations"]["1"],
+        root.get_abs_path(),
+        singularity_image,
+        setup_env_script,
+        status_index,
+    )
+    cs_2 = ClusterSubmission(
+        root.parameters["generations"]["2"],
+        root.get_abs_path(),
+        singularity_image,
+        setup_env_script,
+        status_index,
+    )
+    if cs_1.pilot_jobs or cs_2.pilot_jobs:
+        dependency_mode = None
+    elif "slurm" in cs_1.run_on and "slurm" in cs_2.run_on:
+        dependency_mode = "slurm"
+    elif "htc" in cs_1.run_on and "htc" in cs_2.run_on:
+        dependency_mode = "htc"
+    else:
+        dependency_mode = None
+    if dependency_mode is None:
+        print(
+            "Warning, dependencies between generations are only implemented when both generations"
+            " run on SLURM or on HTCondor (without pilots). Submitting generation 2 jobs per"
+            " completed parent."
+        )
+        submit_jobs_per_parent(root, status_index)
+        return
+
+    # Both generations are on the same cluster, the state of the jobs is queried only once
+    running_jobs, queuing_jobs = cs_2._get_state_jobs(verbose=False)
+    dic_id_to_job = cs_2.dic_id_to_job
+    dic_job_to_id = {job: id_job for id_job, job in (dic_id_to_job or {}).items()}
+
+    l_dag_nodes = []
+    for idx_node, node in enumerate(root.generation(1)):
+        path_file_1 = f"../submission_files/{dic_int_to_str[1]}_generation_{idx_node}.sub"
+        path_file_2 = f"../submission_files/{dic_int_to_str[2]}_generation_{idx_node}.sub"
+
+        # Write the submission files of the parent (if not completed, running or queuing) and of
+        # its children
+        path_job = cs_1._get_path_job(node.get_abs_path())
+        l_filenames_1, l_path_jobs_1 = cs_1._write_sub_files(
+            path_file_1, running_jobs, queuing_jobs, [node]
+        )
+        l_filenames_2, l_path_jobs_2 = cs_2._write_sub_files(
+            path_file_2, running_jobs, queuing_jobs, node.children
+        )
+
+        if not l_filenames_1 and not l_filenames_2:
+            continue
+
+        # Children of a parent submitted previously can only depend on it with SLURM
+        parent_in_queue = not has_been(node, "completed", status_index) and not l_filenames_1
+        if parent_in_queue and (dependency_mode == "htc" or path_job not in dic_job_to_id):
+            print(f"Children of {path_job} will be submitted once it has completed.")
+            for filename in l_filenames_2:
+                os.remove(filename)
+            continue
+
+        if dependency_mode == "slurm":
+            dependency = dic_job_to_id[path_job] if parent_in_queue else None
+            if l_filenames_1:
+                dic_id_to_job_parent = cs_1.submit(
+                    l_filenames_1, l_path_jobs_1, print_status=False
+                )
+                if not dic_id_to_job_parent:
+                    print(f"Warning, could not get the id of {path_job}, skipping its children.")
+                    continue
+                dependency = list(dic_id_to_job_parent)[0]
+            if l_filenames_2:
+                cs_2.submit(l_filenames_2, l_path_jobs_2, dependency, print_status=False)
+        else:
+            name_parent = None
+            if l_filenames_1:
+                name_parent = f"gen_1_{idx_node}"
+                l_dag_nodes.append((name_parent, l_filenames_1[0], l_path_jobs_1, None))
+            if l_filenames_2:
+                l_dag_nodes.append(
+                    (f"gen_2_{idx_node}", l_filenames_2[0], l_path_jobs_2, name_parent)
+                )
+
+    # All the HTCondor jobs are submitted at once
+    if l_dag_nodes:
+        cs_2.submit_dag("../submission_files/study.dag", l_dag_nodes)
+
+    print("Jobs status after submission:")
+    cs_2._get_state_jobs(verbose=True)
+
+
+def submit_jobs(study_name, print_uncompleted_jobs=False, rebuild_status_index=False):
     # Add suffix to the root node path to handle scans that are not in the root directory
     fix = f"/../scans/{study_name}"
     root = tree_maker.tree_from_json(f"{fix[1:]}/tree_maker.json")
     root.add_suffix(suffix=fix)
 
+    # Status of all the nodes, read at once
+    status_index = get_status_index(root, rebuild=rebuild_status_index)
+
     # Check that the study is not done yet
     if root.has_been("completed"):
         print("All descendants of root are completed!")
     else:
-        # Check generation 1
-        gen_1_completed = all([node.has_been("completed") for node in root.generation(1)])
-        if not gen_1_completed:
-            print("######## Taking care of generation 1 ########")
-            submit_jobs_generation(root, generation=1)
-        else:
-            print("Generation 1 is already completed.")
-
-        # Check generation 2
-        gen_2_completed = all([node.has_been("completed") for node in root.generation(2)])
-        if gen_1_completed and not gen_2_completed:
-            print("######## Taking care of generation 2 ########")
-            submit_jobs_generation(root, generation=2)
+        # Submit the whole study at once if requested, otherwise the generation 2 jobs are
+        # submitted as soon as their parent is completed
+        if "submit_with_dependencies" in root.parameters and root.parameters[
+            "submit_with_dependencies"
+        ]:
+            print("######## Taking care of generations 1 and 2 ########")
+            submit_jobs_with_dependencies(root, status_index)
         else:
-            if not gen_1_completed:
-                pass
-            else:
-                print("Generation 2 is already completed.")
+            submit_jobs_per_parent(root, status_index)
 
         # We assume there's no generation 3
-        if all([descendant.has_been("completed") for descendant in root.descendants]):
+        if all(has_been(descendant, "completed", status_index) for descendant in root.descendants):
             root.tag_as("completed")
             print("All descendants of root are completed!")
 
         # Print remaining jobs
         if print_uncompleted_jobs:
             for descendant in root.descendants:
-                if descendant.has_not_been("completed"):
+                if not has_been(descendant, "completed", status_index):
                     print("To be completed: " + descendant.get_abs_path())
 
 
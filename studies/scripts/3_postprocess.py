@@ -2,13 +2,35 @@
 # --- Imports
 # ==================================================================================================
 # Standard library imports
+import glob
+import hashlib
+import json
 import logging
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 
 # Third party imports
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import tree_maker
 
+# Columns of the output files needed to compute the DA
+L_COLUMNS_DA = [
+    "particle_id",
+    "state",
+    "at_turn",
+    "normalized amplitude in xy-plane",
+    "angle in xy-plane [deg]",
+]
+
+# Columns only written by the jobs recording their configuration in the config table of the study
+# (read if present, in addition to the parameters of interest)
+L_COLUMNS_CONFIG = ["beam", "hash_config"]
+
 
 # ==================================================================================================
 # --- Functions to browse simulations folder and extract relevant observables
@@ -20,41 +42,123 @@ def get_from_dict(dataDict, mapList):
     return dataDict
 
 
-def get_particles_data(root):
-    l_df_output = []
+def read_output_file(
+    path_output, columns=None, only_keep_lost_particles=False, columns_optional=None
+):
+    # Only read the requested columns (and the optional ones present in the file), and filter out
+    # the surviving particles while scanning the file if requested (the attributes are always read)
+    try:
+        if columns is not None and columns_optional:
+            columns = columns + [
+                column for column in columns_optional if column in pq.read_schema(path_output).names
+            ]
+        return pd.read_parquet(
+            path_output,
+            columns=columns,
+            filters=[("state", "<=", 0)] if only_keep_lost_particles else None,
+        )
+    except Exception as e:
+        print(e)
+        logging.warning(f"{path_output} could not be read")
+        return None
+
+
+def get_output_files(root):
+    # Get the output files of all the simulations, along with their nodes
+    l_path_output_and_nodes = []
 
     # ? Ideally node tree browsing should be done in a recursive way, but how to know in advance which
     # ? generation is being tracked?
     for node in root.generation(1):
         for node_child in node.children:
-            try:
-                df_output = pd.read_parquet(f"{node_child.get_abs_path()}/output_particles.parquet")
-            except Exception as e:
-                print(e)
+            # Jobs tracking all the chunks of a working point write one output file per chunk
+            l_path_output = sorted(
+                glob.glob(f"{node_child.get_abs_path()}/output_particles*.parquet")
+            )
+            if len(l_path_output) == 0:
                 logging.warning(
                     node_child.get_abs_path() + " does not have output_particles.parquet"
                 )
                 continue
 
-            # Register paths and names of the nodes
-            df_output["path base collider"] = f"{node.get_abs_path()}"
-            df_output["name base collider"] = f"{node.name}"
-            df_output["path simulation"] = f"{node_child.get_abs_path()}"
-            df_output["name simulation"] = f"{node_child.name}"
+            l_path_output_and_nodes.extend(
+                (path_output, node, node_child) for path_output in l_path_output
+            )
+
+    return l_path_output_and_nodes
+
+
+def read_particles_data(
+    l_path_output_and_nodes,
+    columns=None,
+    only_keep_lost_particles=False,
+    n_threads=16,
+    columns_optional=None,
+):
+    # Read the files concurrently (reading parquet files releases the GIL)
+    with ThreadPoolExecutor(n_threads) as executor:
+        l_df_read = list(
+            executor.map(
+                lambda path_output: read_output_file(
+                    path_output, columns, only_keep_lost_particles, columns_optional
+                ),
+                [path_output for path_output, _, _ in l_path_output_and_nodes],
+            )
+        )
+
+    l_df_output = []
+    for df_output, (path_output, node, node_child) in zip(l_df_read, l_path_output_and_nodes):
+        if df_output is None:
+            continue
+
+        # Register paths and names of the nodes (and of the output file)
+        df_output["path output"] = path_output
+        df_output.attrs["path output"] = path_output
+        df_output["path base collider"] = f"{node.get_abs_path()}"
+        df_output["name base collider"] = f"{node.name}"
+        df_output["path simulation"] = f"{node_child.get_abs_path()}"
+        df_output["name simulation"] = f"{node_child.name}"
 
-            # Add to the list
-            l_df_output.append(df_output)
+        # Add to the list
+        l_df_output.append(df_output)
 
     return l_df_output
 
 
-def reorganize_particles_data(l_df_output, dic_parameters_of_interest):
+def get_particles_data(
+    root, columns=None, only_keep_lost_particles=False, n_threads=16, columns_optional=None
+):
+    return read_particles_data(
+        get_output_files(root), columns, only_keep_lost_particles, n_threads, columns_optional
+    )
+
+
+def get_configuration(df_output, path_config_table=None, dic_config_table=None):
+    # Outputs of the jobs not using a config table store their configuration in their attributes
+    if "hash_config" not in df_output.attrs:
+        return df_output.attrs
+
+    # Otherwise, read the entry of the config table (once for all the outputs sharing it)
+    hash_config = df_output.attrs["hash_config"]
+    if hash_config not in dic_config_table:
+        with open(f"{path_config_table}/{hash_config}.json", "r") as fid:
+            dic_config_table[hash_config] = json.load(fid)
+    return dic_config_table[hash_config]
+
+
+def reorganize_particles_data(l_df_output, dic_parameters_of_interest, path_config_table=None):
+    dic_config_table = {}
     for df_output in l_df_output:
+        # Nothing to do if the parameters have been written as columns by the job
+        if all(name in df_output.columns for name in ["beam", *dic_parameters_of_interest]):
+            continue
+
         # Get generation configurations as dictionnaries for parameter assignation
-        dic_child_collider = df_output.attrs["configuration_gen_2"]["config_collider"]
-        dic_child_simulation = df_output.attrs["configuration_gen_2"]["config_simulation"]
-        dic_parent_collider = df_output.attrs["configuration_gen_1"]["config_mad"]
-        dic_parent_particles = df_output.attrs["configuration_gen_1"]["config_particles"]
+        dic_config = get_configuration(df_output, path_config_table, dic_config_table)
+        dic_child_collider = dic_config["configuration_gen_2"]["config_collider"]
+        dic_child_simulation = dic_config["configuration_gen_2"]["config_simulation"]
+        dic_parent_collider = dic_config["configuration_gen_1"]["config_mad"]
+        dic_parent_particles = dic_config["configuration_gen_1"]["config_particles"]
 
         # Get which beam is being tracked
         df_output["beam"] = dic_child_simulation["beam"]
@@ -78,8 +182,9 @@ def merge_and_group_by_parameters_of_interest(
     df_all_sim = pd.concat(l_df_output)
 
     if only_keep_lost_particles:
-        # Extract the particles that were lost for DA computation
-        df_all_sim = df_all_sim[df_all_sim["state"] != 1]  # Lost particles
+        # Extract the particles that were lost for DA computation (alive particles, and particles
+        # inferred stable by the adaptive DA search, have a positive state)
+        df_all_sim = df_all_sim[df_all_sim["state"] <= 0]  # Lost particles
 
     # Check if the dataframe is empty
     if df_all_sim.empty:
@@ -95,6 +200,381 @@ def merge_and_group_by_parameters_of_interest(
     ).transpose()
 
 
+# ==================================================================================================
+# --- Functions to aggregate the data by batches of files (bounded memory)
+#
+# The minimum of each group is the minimum of the minimums of the group over any partition of the
+# particles. The output files are therefore read by batches, and only the minimum of each group
+# over the files read so far is kept in memory, giving the same result as
+# merge_and_group_by_parameters_of_interest.
+# ==================================================================================================
+def get_partial_minimum(
+    l_df_output, l_group_by_parameters, only_keep_lost_particles, l_parameters_to_keep
+):
+    # Minimum of the parameters to keep for each group, with the group parameters as columns, such
+    # that it can be merged with other partial minimums
+    df_all_sim = pd.concat(l_df_output)
+    if only_keep_lost_particles:
+        df_all_sim = df_all_sim[df_all_sim["state"] <= 0]
+    return (
+        df_all_sim.groupby(l_group_by_parameters)[
+            [
+                parameter
+                for parameter in l_parameters_to_keep
+                if parameter not in l_group_by_parameters
+            ]
+        ]
+        .min()
+        .reset_index()
+    )
+
+
+def merge_partial_minimums(l_df_partial, l_group_by_parameters, l_parameters_to_keep):
+    # Same output as merge_and_group_by_parameters_of_interest
+    df_partial = pd.concat(l_df_partial)
+    if df_partial.empty:
+        logging.warning("No unstable particles found, the output dataframe will be empty.")
+    df_grouped = df_partial.groupby(l_group_by_parameters)
+    return pd.DataFrame(
+        [df_grouped[parameter].min() for parameter in l_parameters_to_keep]
+    ).transpose()
+
+
+def aggregate_particles_data(
+    l_path_output_and_nodes,
+    dic_parameters_of_interest,
+    l_group_by_parameters=["beam", "name base collider", "qx", "qy"],
+    only_keep_lost_particles=True,
+    l_parameters_to_keep=["normalized amplitude in xy-plane", "qx", "qy", "dqx", "dqy"],
+    columns=None,
+    columns_optional=None,
+    path_config_table=None,
+    batch_size=1000,
+    n_threads=16,
+):
+    df_running = pd.DataFrame(
+        columns=list(dict.fromkeys(l_group_by_parameters + l_parameters_to_keep))
+    )
+    for idx_first in range(0, len(l_path_output_and_nodes), batch_size):
+        # Read and reorganize a batch of files
+        l_df_output = read_particles_data(
+            l_path_output_and_nodes[idx_first : idx_first + batch_size],
+            columns,
+            only_keep_lost_particles=only_keep_lost_particles,
+            n_threads=n_threads,
+            columns_optional=columns_optional,
+        )
+        l_df_output = reorganize_particles_data(
+            l_df_output, dic_parameters_of_interest, path_config_table
+        )
+        if len(l_df_output) == 0:
+            continue
+
+        # Update the running minimum of each group
+        df_batch = get_partial_minimum(
+            l_df_output, l_group_by_parameters, only_keep_lost_particles, l_parameters_to_keep
+        )
+        if df_running.empty:
+            df_running = df_batch
+        elif not df_batch.empty:
+            df_running = get_partial_minimum(
+                [df_running, df_batch], l_group_by_parameters, False, l_parameters_to_keep
+            )
+        print(
+            f"{min(idx_first + batch_size, len(l_path_output_and_nodes))} output files out of"
+            f" {len(l_path_output_and_nodes)} aggregated"
+        )
+
+    return merge_partial_minimums([df_running], l_group_by_parameters, l_parameters_to_keep)
+
+
+# ==================================================================================================
+# --- Functions to postprocess the data incrementally
+#
+# The output files already processed are recorded in a manifest (path, modification time, size
+# and checksum), along with the minimum of the parameters to keep for each group and each file.
+# Only the new or modified files are read at each refresh, their contribution replacing the former
+# one, such that the final dataframe is the same as if all the files had been read again.
+# ==================================================================================================
+def get_file_checksum(path, chunk_size=2**24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_incremental_state(path_manifest, path_state, dic_settings):
+    # Start from scratch if the postprocessing settings have changed
+    if os.path.isfile(path_manifest) and os.path.isfile(path_state):
+        with open(path_manifest, "r") as fid:
+            manifest = json.load(fid)
+        if manifest["settings"] == dic_settings:
+            return manifest, pd.read_parquet(path_state)
+    return {"settings": dic_settings, "files": {}}, None
+
+
+def write_incremental_state(path_manifest, path_state, manifest, df_state):
+    # State first, such that files can only be processed twice (not missed) if interrupted
+    df_state.to_parquet(f"{path_state}.tmp")
+    os.replace(f"{path_state}.tmp", path_state)
+    with open(f"{path_manifest}.tmp", "w") as fid:
+        json.dump(manifest, fid)
+    os.replace(f"{path_manifest}.tmp", path_manifest)
+
+
+def get_new_output_files(l_path_output_and_nodes, manifest):
+    # Files whose size and modification time are unchanged are not read again, nor are the files
+    # that have been touched without being modified (same checksum). The entries of the new files
+    # are returned separately, to be recorded in the manifest only once the files have been read
+    l_path_output_and_nodes_new = []
+    dic_files_new = {}
+    for path_output, node, node_child in l_path_output_and_nodes:
+        stat = os.stat(path_output)
+        dic_file = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+        if path_output in manifest["files"]:
+            dic_file_manifest = manifest["files"][path_output]
+            if all(dic_file_manifest[key] == dic_file[key] for key in dic_file):
+                continue
+            dic_file["hash"] = get_file_checksum(path_output)
+            if dic_file_manifest["hash"] == dic_file["hash"]:
+                manifest["files"][path_output] = dic_file
+                continue
+        else:
+            dic_file["hash"] = get_file_checksum(path_output)
+        dic_files_new[path_output] = dic_file
+        l_path_output_and_nodes_new.append((path_output, node, node_child))
+    return l_path_output_and_nodes_new, dic_files_new
+
+
+def postprocess_incremental(
+    root,
+    path_study,
+    dic_parameters_of_interest,
+    l_group_by_parameters=["beam", "name base collider", "qx", "qy"],
+    only_keep_lost_particles=True,
+    l_parameters_to_keep=["normalized amplitude in xy-plane", "qx", "qy", "dqx", "dqy"],
+    columns=None,
+):
+    path_config_table = f"{path_study}/config_table"
+    path_manifest = f"{path_study}/postprocess_manifest.json"
+    path_state = f"{path_study}/postprocess_state.parquet"
+    dic_settings = {
+        "parameters_of_interest": dic_parameters_of_interest,
+        "group_by_parameters": l_group_by_parameters,
+        "only_keep_lost_particles": only_keep_lost_particles,
+        "parameters_to_keep": l_parameters_to_keep,
+        "columns": columns,
+    }
+    manifest, df_state = load_incremental_state(path_manifest, path_state, dic_settings)
+
+    # Get the new or modified files, and forget the files that have been removed
+    l_path_output_and_nodes = get_output_files(root)
+    l_path_output_and_nodes_new, dic_files_new = get_new_output_files(
+        l_path_output_and_nodes, manifest
+    )
+    set_path_output = {path_output for path_output, _, _ in l_path_output_and_nodes}
+    for path_output in set(manifest["files"]) - set_path_output:
+        del manifest["files"][path_output]
+    print(
+        f"{len(l_path_output_and_nodes_new)} new or modified output files out of"
+        f" {len(l_path_output_and_nodes)}"
+    )
+
+    # Drop the former contribution of the modified and removed files
+    if df_state is not None:
+        set_path_output_new = {path_output for path_output, _, _ in l_path_output_and_nodes_new}
+        df_state = df_state[
+            df_state["path output"].isin(set_path_output)
+            & ~df_state["path output"].isin(set_path_output_new)
+        ]
+
+    # Get the contribution of the new files (minimum of the parameters for each group and file)
+    l_df_output = read_particles_data(
+        l_path_output_and_nodes_new,
+        columns,
+        only_keep_lost_particles=only_keep_lost_particles,
+        columns_optional=L_COLUMNS_CONFIG + list(dic_parameters_of_interest),
+    )
+    l_df_output = reorganize_particles_data(
+        l_df_output, dic_parameters_of_interest, path_config_table
+    )
+
+    # Only record the files that could be read, the others (e.g. being written) are read again at
+    # the next refresh
+    set_path_output_read = {df_output.attrs["path output"] for df_output in l_df_output}
+    for path_output, dic_file in dic_files_new.items():
+        if path_output in set_path_output_read:
+            manifest["files"][path_output] = dic_file
+        else:
+            manifest["files"].pop(path_output, None)
+    if len(l_df_output) > 0:
+        df_new = get_partial_minimum(
+            l_df_output,
+            l_group_by_parameters + ["path output"],
+            only_keep_lost_particles,
+            l_parameters_to_keep,
+        )
+        df_state = df_new if df_state is None else pd.concat([df_state, df_new])
+
+    if df_state is None or df_state.empty:
+        df_state = pd.DataFrame(
+            columns=list(
+                dict.fromkeys(l_group_by_parameters + ["path output"] + l_parameters_to_keep)
+            )
+        )
+    write_incremental_state(path_manifest, path_state, manifest, df_state)
+
+    # Merge the contributions of all the files
+    return merge_partial_minimums([df_state], l_group_by_parameters, l_parameters_to_keep)
+
+
+# ==================================================================================================
+# --- Functions to read the results dataset of the study
+#
+# The jobs publish their outputs in a dataset partitioned by beam, base collider and scanned
+# parameters (hive layout, e.g. results/beam=lhcb1/base_collider=base_collider/qx=62.31/qy=60.32).
+# A summary of the footers of all the files (_metadata) is maintained, such that the dataset can
+# be queried (and partitions pruned) without listing it. Files are recorded in a sidecar file,
+# along with their modification time and size, and with the types of the partitions.
+# ==================================================================================================
+def _get_partition_type(l_values):
+    # Partition values are stored as strings in the paths
+    for type_partition, cast in [(pa.int64(), int), (pa.float64(), float)]:
+        try:
+            for value in l_values:
+                cast(value)
+            return type_partition
+        except ValueError:
+            continue
+    return pa.string()
+
+
+def update_results_metadata(path_dataset):
+    path_metadata = f"{path_dataset}/_metadata"
+    path_files = f"{path_dataset}/_metadata_files.json"
+
+    # Files of the dataset (temporary files being written are hidden)
+    dic_files = {}
+    for path_file in glob.glob(f"{path_dataset}/**/*.parquet", recursive=True):
+        stat = os.stat(path_file)
+        dic_files[os.path.relpath(path_file, path_dataset)] = [stat.st_mtime_ns, stat.st_size]
+
+    # Row groups can't be removed from the summary, it is rebuilt if files have been modified (e.g.
+    # job run again) or removed. Otherwise, only the footers of the new files are read
+    metadata = None
+    dic_files_metadata = {}
+    if os.path.isfile(path_metadata) and os.path.isfile(path_files):
+        with open(path_files, "r") as fid:
+            dic_files_metadata = json.load(fid)["files"]
+        if all(dic_files.get(path) == value for path, value in dic_files_metadata.items()):
+            metadata = pq.read_metadata(path_metadata)
+        else:
+            dic_files_metadata = {}
+
+    l_path_files_new = sorted(set(dic_files) - set(dic_files_metadata))
+    print(f"{len(l_path_files_new)} new files in the results dataset")
+    for path_file in l_path_files_new:
+        metadata_file = pq.read_metadata(f"{path_dataset}/{path_file}")
+        metadata_file.set_file_path(path_file)
+        if metadata is None:
+            metadata = metadata_file
+        else:
+            # The summary is only read through _metadata, a file left out would silently be
+            # missing from the results
+            try:
+                metadata.append_row_groups(metadata_file)
+            except RuntimeError as e:
+                raise RuntimeError(
+                    f"{path_file} does not have the schema of the results dataset, it must be"
+                    " published again (or removed) before the dataset can be summarized"
+                ) from e
+        dic_files_metadata[path_file] = dic_files[path_file]
+    if metadata is None:
+        logging.warning("The results dataset is empty")
+        return
+
+    # Types of the partitions, from their values
+    dic_partition_values = {}
+    for path_file in dic_files_metadata:
+        for segment in os.path.dirname(path_file).split(os.sep):
+            key, _, value = segment.partition("=")
+            dic_partition_values.setdefault(key, set()).add(unquote(value))
+    dic_partition_types = {
+        key: str(_get_partition_type(l_values)) for key, l_values in dic_partition_values.items()
+    }
+
+    # Write the summary, then the files it contains
+    pq.write_metadata(
+        metadata.schema.to_arrow_schema(), f"{path_metadata}.tmp", metadata_collector=[metadata]
+    )
+    os.replace(f"{path_metadata}.tmp", path_metadata)
+    with open(f"{path_files}.tmp", "w") as fid:
+        json.dump({"partitions": dic_partition_types, "files": dic_files_metadata}, fid)
+    os.replace(f"{path_files}.tmp", path_files)
+
+
+def get_results_dataset(path_dataset):
+    # Dataset built from the summary (no listing of the dataset)
+    with open(f"{path_dataset}/_metadata_files.json", "r") as fid:
+        dic_partition_types = json.load(fid)["partitions"]
+    partitioning = ds.partitioning(
+        pa.schema(
+            [
+                (key, pa.type_for_alias(type_partition))
+                for key, type_partition in dic_partition_types.items()
+            ]
+        ),
+        flavor="hive",
+    )
+    return ds.parquet_dataset(f"{path_dataset}/_metadata", partitioning=partitioning)
+
+
+def aggregate_results_dataset(
+    path_dataset,
+    l_group_by_parameters=["beam", "name base collider", "qx", "qy"],
+    only_keep_lost_particles=True,
+    l_parameters_to_keep=["normalized amplitude in xy-plane", "qx", "qy", "dqx", "dqy"],
+    filter_dataset=None,
+    batch_size=2**20,
+):
+    # Same output as aggregate_particles_data, with a running minimum over batches of rows. The
+    # base collider is named base_collider in the dataset. An expression can be given to only read
+    # part of the dataset (e.g. ds.field("qx") == 62.31, only reading the matching partitions)
+    dic_rename = {"base_collider": "name base collider"}
+    l_columns = [
+        {value: key for key, value in dic_rename.items()}.get(column, column)
+        for column in dict.fromkeys(l_group_by_parameters + l_parameters_to_keep)
+    ]
+    if only_keep_lost_particles:
+        filter_lost = ds.field("state") <= 0
+        filter_dataset = filter_lost if filter_dataset is None else filter_dataset & filter_lost
+
+    scanner = get_results_dataset(path_dataset).scanner(
+        columns=l_columns, filter=filter_dataset, batch_size=batch_size
+    )
+    df_running = pd.DataFrame(
+        columns=list(dict.fromkeys(l_group_by_parameters + l_parameters_to_keep))
+    )
+    for batch in scanner.to_batches():
+        if batch.num_rows == 0:
+            continue
+        df_batch = get_partial_minimum(
+            [batch.to_pandas().rename(columns=dic_rename)],
+            l_group_by_parameters,
+            False,
+            l_parameters_to_keep,
+        )
+        if df_running.empty:
+            df_running = df_batch
+        else:
+            df_running = get_partial_minimum(
+                [df_running, df_batch], l_group_by_parameters, False, l_parameters_to_keep
+            )
+
+    return merge_partial_minimums([df_running], l_group_by_parameters, l_parameters_to_keep)
+
+
 # ==================================================================================================
 # --- Postprocess the data
 # ==================================================================================================
@@ -110,8 +590,10 @@ if __name__ == "__main__":
     # Add suffix to the root node path to handle scans that are not in the root directory
     root.add_suffix(suffix=fix)
 
-    # Get particles data
-    l_df_output = get_particles_data(root)
+    # Set to True to only read the new or modified output files since the last postprocessing
+    # (a manifest and the partial aggregates are then kept in the study folder, and discarded if
+    # the postprocessing settings change)
+    incremental = False
 
     # Define parameters of interest
     dic_parameters_of_interest = {
@@ -124,10 +606,7 @@ if __name__ == "__main__":
         "num_particles_per_bunch": ["config_beambeam", "num_particles_per_bunch"],
     }
 
-    # Reorganize data
-    l_df_output = reorganize_particles_data(l_df_output, dic_parameters_of_interest)
-
-    # Merge and group by parameters of interest
+    # Parameters to group by, and parameters to keep
     l_group_by_parameters = ["beam", "name base collider", "qx", "qy"]
     l_parameters_to_keep = [
         "normalized amplitude in xy-plane",
@@ -140,9 +619,38 @@ if __name__ == "__main__":
         "num_particles_per_bunch",
     ]
     only_keep_lost_particles = True
-    df_final = merge_and_group_by_parameters_of_interest(
-        l_df_output, l_group_by_parameters, only_keep_lost_particles, l_parameters_to_keep
-    )
+
+    # Read the results dataset of the study if the jobs publish their outputs there (otherwise, the
+    # output files are found through the tree)
+    path_dataset = f"../scans/{study_name}/results"
+    if os.path.isdir(path_dataset) and os.listdir(path_dataset):
+        update_results_metadata(path_dataset)
+        df_final = aggregate_results_dataset(
+            path_dataset, l_group_by_parameters, only_keep_lost_particles, l_parameters_to_keep
+        )
+    elif incremental:
+        df_final = postprocess_incremental(
+            root,
+            f"../scans/{study_name}",
+            dic_parameters_of_interest,
+            l_group_by_parameters,
+            only_keep_lost_particles,
+            l_parameters_to_keep,
+            columns=L_COLUMNS_DA,
+        )
+    else:
+        # Read all the output files by batches (only the lost particles, and the columns needed for
+        # the DA), and group by parameters of interest
+        df_final = aggregate_particles_data(
+            get_output_files(root),
+            dic_parameters_of_interest,
+            l_group_by_parameters,
+            only_keep_lost_particles,
+            l_parameters_to_keep,
+            columns=L_COLUMNS_DA,
+            columns_optional=L_COLUMNS_CONFIG + list(dic_parameters_of_interest),
+            path_config_table=f"../scans/{study_name}/config_table",
+        )
     print("Final dataframe for current set of simulations: ", df_final)
 
     # Save data and print time
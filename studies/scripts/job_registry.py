@@ -0,0 +1,197 @@
+"""This script implements the registry of the jobs submitted for a study, replacing the former
+id_job.yaml file. The registry is an SQLite database (in WAL mode on local disks, and with the
+default rollback journal on network filesystems), indexed by job id and job path, which keeps track
+of the submissions, and of the state and timestamps of each job. Updates are transactional, such
+that several submission scripts can safely use the same registry. The jobs still active can be
+exported to the former yaml format for compatibility."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Standard library imports
+import argparse
+import contextlib
+import os
+import re
+import sqlite3
+import time
+
+# Third party imports
+import yaml
+
+# States of the jobs in the registry (jobs that are not submitted, running or queuing anymore are
+# kept as finished for reference)
+L_STATES_ACTIVE = ["submitted", "running", "queuing"]
+STATE_FINISHED = "finished"
+
+
+# Filesystems on which SQLite must not use WAL mode (it relies on shared memory between the
+# processes accessing the database, which is not available across the nodes of a cluster)
+S_FS_NETWORK = {"afs", "nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "ceph", "fuse"}
+
+
+# ==================================================================================================
+# --- Function to get the filesystem of the registry
+# ==================================================================================================
+def is_on_network_filesystem(path):
+    # Find the filesystem of the deepest mount point containing the path (EOS is mounted through
+    # fuse). If the mount points can't be read, the path is assumed to be on a network filesystem
+    path = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    try:
+        with open("/proc/mounts") as fid:
+            l_mounts = [line.split()[1:3] for line in fid if len(line.split()) > 2]
+    except OSError:
+        return True
+    mount_point_best, fs_type_best = "", None
+    for mount_point, fs_type in l_mounts:
+        # Spaces and other special characters are escaped in octal in /proc/mounts
+        mount_point = re.sub(r"\\([0-7]{3})", lambda match: chr(int(match[1], 8)), mount_point)
+        if (
+            path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        ) and len(mount_point) > len(mount_point_best):
+            mount_point_best, fs_type_best = mount_point, fs_type
+    if fs_type_best is None:
+        return True
+    return fs_type_best.split(".")[0] in S_FS_NETWORK
+
+
+# ==================================================================================================
+# --- Functions to convert the job ids
+# ==================================================================================================
+def format_id_job(id_job):
+    # Ids are integers (job or cluster id), or strings (HTC cluster and process ids, or SLURM job
+    # array and task ids)
+    return str(id_job) if "." in str(id_job) or "_" in str(id_job) else int(id_job)
+
+
+# ==================================================================================================
+# --- Class for the job registry
+# ==================================================================================================
+class JobRegistry:
+    def __init__(self, path_db, timeout=60.0):
+        self.path_db = path_db
+        self.timeout = timeout
+        self.journal_mode = "DELETE" if is_on_network_filesystem(path_db) else "WAL"
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS submissions ("
+                " id_submission INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " run_on TEXT,"
+                " filename TEXT,"
+                " time_submission REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id_job TEXT PRIMARY KEY,"
+                " path_job TEXT NOT NULL,"
+                " id_submission INTEGER REFERENCES submissions(id_submission),"
+                " state TEXT NOT NULL,"
+                " time_submission REAL,"
+                " time_update REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_path ON jobs(path_job)")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state)")
+
+    def _connect(self):
+        # Autocommit mode, transactions are started explicitly
+        connection = sqlite3.connect(self.path_db, timeout=self.timeout, isolation_level=None)
+        # WAL mode allows reading while another submission script is writing, but it can corrupt or
+        # deadlock the database on network filesystems (AFS, EOS, NFS, etc.), on which the default
+        # rollback journal is used instead
+        connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        connection.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # The write lock is taken at the start of the transaction, such that concurrent submission
+        # scripts wait for each other instead of failing on conflicting updates
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def has_submissions(self):
+        with contextlib.closing(self._connect()) as connection:
+            return connection.execute("SELECT 1 FROM submissions LIMIT 1").fetchone() is not None
+
+    def add_jobs(self, dic_id_to_job, run_on=None, filename=None):
+        # Record a submission and its jobs, all at once
+        time_now = time.time()
+        with self._transaction() as connection:
+            id_submission = connection.execute(
+                "INSERT INTO submissions (run_on, filename, time_submission) VALUES (?, ?, ?)",
+                (run_on, filename, time_now),
+            ).lastrowid
+            connection.executemany(
+                "INSERT OR REPLACE INTO jobs"
+                " (id_job, path_job, id_submission, state, time_submission, time_update)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (str(id_job), path_job, id_submission, "submitted", time_now, time_now)
+                    for id_job, path_job in dic_id_to_job.items()
+                ],
+            )
+
+    def get_dic_id_to_job(self):
+        # Jobs still active only
+        with contextlib.closing(self._connect()) as connection:
+            l_rows = connection.execute(
+                f"SELECT id_job, path_job FROM jobs WHERE state IN"
+                f" ({', '.join('?' * len(L_STATES_ACTIVE))})",
+                L_STATES_ACTIVE,
+            ).fetchall()
+        return {format_id_job(id_job): path_job for id_job, path_job in l_rows}
+
+    def update_states(self, running_jobs, queuing_jobs):
+        # Jobs that are not running or queuing anymore are finished
+        dic_state = {job: "queuing" for job in queuing_jobs}
+        dic_state.update({job: "running" for job in running_jobs})
+        time_now = time.time()
+        with self._transaction() as connection:
+            l_rows = connection.execute(
+                f"SELECT id_job, path_job, state FROM jobs WHERE state IN"
+                f" ({', '.join('?' * len(L_STATES_ACTIVE))})",
+                L_STATES_ACTIVE,
+            ).fetchall()
+            l_updates = []
+            for id_job, path_job, state in l_rows:
+                new_state = dic_state[path_job] if path_job in dic_state else STATE_FINISHED
+                if new_state != state:
+                    l_updates.append((new_state, time_now, id_job))
+            connection.executemany(
+                "UPDATE jobs SET state = ?, time_update = ? WHERE id_job = ?", l_updates
+            )
+
+    def import_yaml(self, path_yaml):
+        # Migrate the jobs of a former id-job file
+        with open(path_yaml, "r") as fid:
+            dic_id_to_job = yaml.load(fid, Loader=yaml.FullLoader)
+        if dic_id_to_job:
+            self.add_jobs(dic_id_to_job, filename=path_yaml)
+
+    def export_yaml(self, path_yaml):
+        # Write the jobs still active in the former id-job format
+        dic_id_to_job = self.get_dic_id_to_job()
+        with open(f"{path_yaml}.tmp", "w") as fid:
+            yaml.dump(dic_id_to_job, fid)
+        os.replace(f"{path_yaml}.tmp", path_yaml)
+
+
+# ==================================================================================================
+# --- Script for execution (export)
+# ==================================================================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the job registry of a study to yaml")
+    parser.add_argument("path_db", help="Path of the registry (e.g. scans/<study>/id_job.db)")
+    parser.add_argument("path_yaml", help="Path of the yaml file to write (e.g. id_job.yaml)")
+    args = parser.parse_args()
+
+    JobRegistry(args.path_db).export_yaml(args.path_yaml)
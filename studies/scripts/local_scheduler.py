@@ -0,0 +1,289 @@
+"""This script implements a scheduler for the jobs run on a local machine. Jobs are queued in a
+file, and run in a pool of processes bounded by a maximum number of concurrent jobs and,
+optionally, a memory budget per job. The state of the jobs (queuing or running) is written to a
+file, such that it can be queried by the submission script. The scheduler runs either in the
+foreground (until all the jobs are done), or as a daemon detached from the submitting shell (until
+no job is left)."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Standard library imports
+import argparse
+import contextlib
+import fcntl
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Third party imports
+import psutil
+
+
+# ==================================================================================================
+# --- Functions to get the files of the scheduler
+# ==================================================================================================
+def get_path_queue(path_root):
+    return f"{path_root}/local_scheduler_queue.txt"
+
+
+def get_path_state(path_root):
+    return f"{path_root}/local_scheduler_state.json"
+
+
+def get_path_log(path_root):
+    return f"{path_root}/local_scheduler.log"
+
+
+@contextlib.contextmanager
+def scheduler_lock(path_root):
+    # Lock shared by the scheduler and the submission, such that no job is submitted to a daemon
+    # about to exit
+    with open(f"{path_root}/local_scheduler.lock", "a") as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+def read_state(path_root):
+    path_state = get_path_state(path_root)
+    if not os.path.isfile(path_state):
+        return None
+    try:
+        with open(path_state, "r") as fid:
+            return json.load(fid)
+    except ValueError:
+        # State being written
+        return None
+
+
+def is_scheduler_alive(state):
+    if state is None or state["pid"] is None:
+        return False
+    # The creation time of the process guards against the reuse of its pid
+    try:
+        return psutil.Process(state["pid"]).create_time() == state["create_time"]
+    except psutil.Error:
+        return False
+
+
+# ==================================================================================================
+# --- Class for the local scheduler
+# ==================================================================================================
+class LocalScheduler:
+    def __init__(
+        self,
+        path_root,
+        n_workers=None,
+        memory_per_job_gb=None,
+        policy="fifo",
+        time_poll=1.0,
+        timeout_idle=60.0,
+    ):
+        self.path_root = path_root
+
+        # Default to the number of physical cores
+        if n_workers is None:
+            n_workers = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+        self.n_workers = n_workers
+
+        # Memory budget per job (None to disable)
+        self.memory_per_job = memory_per_job_gb * 1e9 if memory_per_job_gb is not None else None
+
+        if policy not in ["fifo", "priority"]:
+            raise ValueError(f"Error: Queue policy {policy} is not implemented")
+        self.policy = policy
+
+        self.time_poll = time_poll
+        self.timeout_idle = timeout_idle
+
+        # Jobs waiting to be run (heap of (priority key, submission index, path node, path job)),
+        # and jobs being run (path job to (process, path node))
+        self.queue = []
+        self.running = {}
+        self.n_submitted = 0
+        self.offset_queue_file = 0
+
+    def _read_queue_file(self):
+        # Read the jobs appended to the queue file since the last read (complete lines only)
+        path_queue = get_path_queue(self.path_root)
+        if not os.path.isfile(path_queue):
+            return
+        with open(path_queue, "r") as fid:
+            fid.seek(self.offset_queue_file)
+            content = fid.read()
+        content = content[: content.rfind("\n") + 1]
+        self.offset_queue_file += len(content.encode("utf-8"))
+
+        l_jobs_known = {job[3] for job in self.queue} | set(self.running)
+        for line in content.splitlines():
+            priority, path_node, path_job = json.loads(line)
+            if path_job in l_jobs_known:
+                continue
+            # Higher priority first for the priority policy, submission order otherwise
+            key = -int(priority) if self.policy == "priority" else 0
+            heapq.heappush(self.queue, (key, self.n_submitted, path_node, path_job))
+            self.n_submitted += 1
+
+    def _reap_jobs(self):
+        for path_job, (process, path_node) in list(self.running.items()):
+            if process.poll() is not None:
+                print(f"Job {path_node} finished with return code {process.returncode}", flush=True)
+                del self.running[path_job]
+
+    def _get_memory_used(self, process):
+        # Resident memory of a job, including the processes it started (run.sh runs python)
+        try:
+            process = psutil.Process(process.pid)
+            l_processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return 0
+        memory_used = 0
+        for process in l_processes:
+            with contextlib.suppress(psutil.Error):
+                memory_used += process.memory_info().rss
+        return memory_used
+
+    def _can_start_job(self):
+        if len(self.running) >= self.n_workers:
+            return False
+        if self.memory_per_job is not None and self.running:
+            # Keep the sum of the budgets below the total memory
+            memory = psutil.virtual_memory()
+            if (len(self.running) + 1) * self.memory_per_job > memory.total:
+                return False
+
+            # The memory currently available must be enough for the new job, once the running jobs
+            # have grown to their budget (they use less memory than their budget when they start,
+            # such that jobs started together would otherwise oversubscribe the memory). This is
+            # checked again before each start
+            memory_reserved = sum(
+                max(self.memory_per_job - self._get_memory_used(process), 0)
+                for process, _ in self.running.values()
+            )
+            if memory.available - memory_reserved < self.memory_per_job:
+                return False
+        return True
+
+    def _start_jobs(self):
+        while self.queue and self._can_start_job():
+            _, _, path_node, path_job = heapq.heappop(self.queue)
+            print(f"Starting job {path_node}", flush=True)
+            process = subprocess.Popen(
+                ["bash", f"{path_node}/run.sh"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self.running[path_job] = (process, path_node)
+
+    def _write_state(self, pid):
+        state = {
+            "pid": pid,
+            "create_time": psutil.Process(pid).create_time() if pid is not None else None,
+            "queuing": [job[3] for job in sorted(self.queue)],
+            "running": list(self.running),
+        }
+        path_state = get_path_state(self.path_root)
+        with open(f"{path_state}.tmp", "w") as fid:
+            json.dump(state, fid)
+        os.replace(f"{path_state}.tmp", path_state)
+
+    def run(self):
+        time_last_job = time.time()
+        while True:
+            self._reap_jobs()
+            self._read_queue_file()
+            self._start_jobs()
+            self._write_state(os.getpid())
+
+            if self.queue or self.running:
+                time_last_job = time.time()
+            elif time.time() - time_last_job > self.timeout_idle:
+                # Exit when no job has been submitted for a while, unless jobs have just been
+                # submitted (checked under lock, see submit_to_local_scheduler)
+                with scheduler_lock(self.path_root):
+                    self._read_queue_file()
+                    if not self.queue:
+                        self._write_state(None)
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(get_path_queue(self.path_root))
+                        print("No job left, exiting", flush=True)
+                        return
+
+            time.sleep(self.time_poll)
+
+
+# ==================================================================================================
+# --- Functions to submit and query jobs
+# ==================================================================================================
+def submit_to_local_scheduler(
+    path_root,
+    l_jobs,
+    n_workers=None,
+    memory_per_job_gb=None,
+    policy="fifo",
+    detach=True,
+):
+    # l_jobs is a list of (priority, path node, path job). Jobs are queued as json lines, such that
+    # paths may contain spaces
+    with scheduler_lock(path_root):
+        # Append the jobs to the queue of the running scheduler if any, otherwise start a new queue
+        # (the queue of a scheduler that has been killed is discarded)
+        scheduler_alive = is_scheduler_alive(read_state(path_root))
+        with open(get_path_queue(path_root), "a" if scheduler_alive else "w") as fid:
+            for priority, path_node, path_job in l_jobs:
+                fid.write(json.dumps([priority, path_node, path_job]) + "\n")
+
+        # Nothing else to do if a scheduler is already running (it will read the queue)
+        if scheduler_alive:
+            print("Jobs added to the queue of the running local scheduler")
+            return
+
+        # Otherwise, start a new scheduler
+        l_args = [str(path_root), "--policy", policy]
+        if n_workers is not None:
+            l_args += ["--n-workers", str(n_workers)]
+        if memory_per_job_gb is not None:
+            l_args += ["--memory-per-job-gb", str(memory_per_job_gb)]
+        if detach:
+            # New session, such that the daemon survives the submitting shell
+            with open(get_path_log(path_root), "a") as fid_log:
+                process = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__)] + l_args,
+                    stdin=subprocess.DEVNULL,
+                    stdout=fid_log,
+                    stderr=fid_log,
+                    start_new_session=True,
+                )
+            print(f"Local scheduler started in the background (pid {process.pid})")
+            return
+
+    # Run in the foreground (outside of the lock, as the scheduler uses it)
+    print("Local scheduler running in the foreground")
+    LocalScheduler(path_root, n_workers, memory_per_job_gb, policy, timeout_idle=0).run()
+
+
+def get_local_scheduler_jobs(path_root, status="running"):
+    state = read_state(path_root)
+    if not is_scheduler_alive(state):
+        return []
+    return state[status] if status in state else []
+
+
+# ==================================================================================================
+# --- Script for execution (daemon)
+# ==================================================================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local scheduler for the jobs of a study")
+    parser.add_argument("path_root", help="Path of the study (root of the tree)")
+    parser.add_argument("--n-workers", type=int, default=None)
+    parser.add_argument("--memory-per-job-gb", type=float, default=None)
+    parser.add_argument("--policy", default="fifo", choices=["fifo", "priority"])
+    args = parser.parse_args()
+
+    LocalScheduler(args.path_root, args.n_workers, args.memory_per_job_gb, args.policy).run()
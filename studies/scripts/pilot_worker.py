@@ -0,0 +1,329 @@
+"""This script implements the pilot workers, used to run many short jobs without paying the cost of
+setting up the environment and importing the simulation packages for each of them. The jobs of a
+study are put in a queue (a folder of files on the shared filesystem), from which long-lived
+workers pull the job folders and run the job executable, either in a fork of a pre-warmed process
+(default), or directly in the worker process. The workers exit once the queue is empty. The job
+executable tags its node as usual (started, completed), such that tree_maker stays up to date.
+Workers can also claim several jobs at once (packing), in which case the executable is run once,
+with the folders of all the claimed jobs as arguments (e.g. to share a GPU between them, which only
+amortizes the overhead of the jobs, as they are still tracked one after the other)."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Standard library imports
+import argparse
+import contextlib
+import glob
+import os
+import runpy
+import shutil
+import socket
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import quote, unquote
+
+# Files removed from the job folder after the job, as in run.sh
+L_PATTERNS_CLEANUP = [
+    "final_*",
+    "modules",
+    "optics_repository",
+    "optics_toolkit",
+    "tools",
+    "tracking_tools",
+    "temp",
+    "mad_collider.log",
+    "__pycache__",
+    "twiss*",
+    "errors",
+    "fc*",
+    "optics_orbit_at*",
+]
+
+
+# ==================================================================================================
+# --- Functions to manage the queue
+# ==================================================================================================
+# The queue is made of one file per job, moved (atomically) from a folder to another: pending (not
+# claimed yet), running (claimed by a worker, which touches the file while the job runs) and
+# failed. The name of each file is the (quoted) path of the job, its content the path of the node
+def get_path_queue(path_root, state="pending"):
+    return f"{path_root}/pilot_queue/{state}"
+
+
+def _get_name(path_job):
+    return quote(path_job, safe="")
+
+
+def enqueue_jobs(path_root, l_path_nodes, l_path_jobs):
+    for state in ["pending", "running", "failed"]:
+        os.makedirs(get_path_queue(path_root, state), exist_ok=True)
+
+    for path_node, path_job in zip(l_path_nodes, l_path_jobs):
+        name = _get_name(path_job)
+        if os.path.isfile(f"{get_path_queue(path_root, 'running')}/{name}"):
+            continue
+
+        # Failed jobs are given another chance
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f"{get_path_queue(path_root, 'failed')}/{name}")
+
+        # Write the entry in a temporary file first, such that workers never read it partially
+        path_tmp = f"{get_path_queue(path_root)}/.{name}.tmp.{socket.gethostname()}.{os.getpid()}"
+        with open(path_tmp, "w") as fid:
+            fid.write(path_node)
+        os.replace(path_tmp, f"{get_path_queue(path_root)}/{name}")
+
+
+def get_pilot_jobs(path_root, status="running"):
+    state = "pending" if status == "queuing" else status
+    path_queue = get_path_queue(path_root, state)
+    if not os.path.isdir(path_queue):
+        return []
+    return [unquote(name) for name in os.listdir(path_queue) if not name.startswith(".")]
+
+
+def requeue_stale_jobs(path_root, timeout_heartbeat):
+    # Jobs whose worker died (no heartbeat for a while) are put back in the queue
+    for path_entry in glob.glob(f"{get_path_queue(path_root, 'running')}/*"):
+        try:
+            if time.time() - os.path.getmtime(path_entry) > timeout_heartbeat:
+                os.rename(path_entry, f"{get_path_queue(path_root)}/{os.path.basename(path_entry)}")
+                print(f"Job {unquote(os.path.basename(path_entry))} put back in the queue")
+        except OSError:
+            # Finished or requeued by another worker in the meantime
+            continue
+
+
+def claim_job(path_root):
+    # Renaming is atomic: only one worker gets each job
+    for name in sorted(os.listdir(get_path_queue(path_root))):
+        if name.startswith("."):
+            continue
+        path_entry = f"{get_path_queue(path_root, 'running')}/{name}"
+        try:
+            os.rename(f"{get_path_queue(path_root)}/{name}", path_entry)
+        except OSError:
+            continue
+        os.utime(path_entry)
+        with open(path_entry, "r") as fid:
+            return path_entry, fid.read().strip()
+    return None, None
+
+
+def claim_jobs(path_root, n_jobs=1):
+    l_path_entries = []
+    l_path_nodes = []
+    for _ in range(n_jobs):
+        path_entry, path_node = claim_job(path_root)
+        if path_entry is None:
+            break
+        l_path_entries.append(path_entry)
+        l_path_nodes.append(path_node)
+    return l_path_entries, l_path_nodes
+
+
+# ==================================================================================================
+# --- Functions to run the jobs
+# ==================================================================================================
+def _cleanup_node(path_node):
+    for pattern in L_PATTERNS_CLEANUP:
+        for path in glob.glob(f"{path_node}/{pattern}"):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+
+@contextlib.contextmanager
+def _redirect_outputs(path_node):
+    # Redirect at the file descriptor level, to also get the outputs of the compiled libraries
+    # (e.g. MAD-X), as the job would with run.sh
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd_stdout, fd_stderr = os.dup(1), os.dup(2)
+    with open(f"{path_node}/output_python.txt", "w") as fid_out, open(
+        f"{path_node}/error_python.txt", "w"
+    ) as fid_err:
+        os.dup2(fid_out.fileno(), 1)
+        os.dup2(fid_err.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(fd_stdout, 1)
+            os.dup2(fd_stderr, 2)
+            os.close(fd_stdout)
+            os.close(fd_stderr)
+
+
+def _run_executable(path_node, executable, l_args=()):
+    # Run the executable of the job as a script, from the job folder
+    cwd = os.getcwd()
+    os.chdir(path_node)
+    sys.path.insert(0, path_node)
+    sys.argv = [f"{path_node}/{executable}"] + list(l_args)
+    try:
+        with _redirect_outputs(path_node):
+            try:
+                runpy.run_path(f"{path_node}/{executable}", run_name="__main__")
+                return True
+            except SystemExit as e:
+                return e.code in [None, 0]
+            except BaseException:
+                traceback.print_exc()
+                return False
+    finally:
+        sys.path.remove(path_node)
+        os.chdir(cwd)
+
+
+def run_job(l_path_nodes, executable, l_path_entries, fork=True, time_heartbeat=30.0):
+    # A single job is run from its folder. Packed jobs are run from the folder of the first job
+    # (where their outputs are written), with the folders of all the jobs as arguments
+    path_node = l_path_nodes[0]
+    l_args = l_path_nodes if len(l_path_nodes) > 1 else []
+    if fork:
+        # The child inherits the imported modules of the worker
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if _run_executable(path_node, executable, l_args) else 1)
+        time_last_heartbeat = time.time()
+        while True:
+            pid_done, status = os.waitpid(pid, os.WNOHANG)
+            if pid_done != 0:
+                success = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+                break
+            if time.time() - time_last_heartbeat > time_heartbeat:
+                for path_entry in l_path_entries:
+                    with contextlib.suppress(OSError):
+                        os.utime(path_entry)
+                time_last_heartbeat = time.time()
+            time.sleep(1.0)
+    else:
+        # The job runs in the worker itself, keeping compiled kernels from one job to the next.
+        # The heartbeat is sent from a thread
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(time_heartbeat):
+                for path_entry in l_path_entries:
+                    with contextlib.suppress(OSError):
+                        os.utime(path_entry)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            success = _run_executable(path_node, executable, l_args)
+        finally:
+            stop.set()
+            thread.join()
+
+    for path_node in l_path_nodes:
+        _cleanup_node(path_node)
+    return success
+
+
+def warm_up(path_root, executable):
+    # Import the modules used by the job executable (taken from any job of the queue), such that
+    # the jobs don't pay for it
+    for path_state in [get_path_queue(path_root), get_path_queue(path_root, "running")]:
+        for path_entry in glob.glob(f"{path_state}/*"):
+            try:
+                with open(path_entry, "r") as fid:
+                    path_node = fid.read().strip()
+            except OSError:
+                continue
+            sys.path.insert(0, path_node)
+            try:
+                runpy.run_path(f"{path_node}/{executable}", run_name="pilot_warm_up")
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.path.remove(path_node)
+            return
+
+
+def run_worker(
+    path_root,
+    executable,
+    fork=True,
+    max_time=None,
+    time_heartbeat=30.0,
+    timeout_heartbeat=600.0,
+    pack_size=1,
+):
+    time_start = time.time()
+    while max_time is None or time.time() - time_start < max_time:
+        requeue_stale_jobs(path_root, timeout_heartbeat)
+        l_path_entries, l_path_nodes = claim_jobs(path_root, pack_size)
+        if not l_path_entries:
+            print("Queue is empty, exiting", flush=True)
+            return
+
+        print(f"Running job(s) {', '.join(l_path_nodes)}", flush=True)
+        success = run_job(l_path_nodes, executable, l_path_entries, fork, time_heartbeat)
+        print(f"Job(s) {'completed' if success else 'failed'}", flush=True)
+
+        # Jobs that failed are kept aside, such that they are not retried forever (the jobs of a
+        # pack that failed are all kept aside, the completed ones are skipped at resubmission)
+        for path_entry in l_path_entries:
+            with contextlib.suppress(OSError):
+                if success:
+                    os.remove(path_entry)
+                else:
+                    os.rename(
+                        path_entry,
+                        f"{get_path_queue(path_root, 'failed')}/{os.path.basename(path_entry)}",
+                    )
+
+    print("Maximum time reached, exiting", flush=True)
+
+
+def run_pilot(path_root, executable, n_workers=1, fork=True, **kwargs):
+    # Import once, then share the imported modules with all the workers through fork
+    warm_up(path_root, executable)
+    if n_workers == 1:
+        run_worker(path_root, executable, fork, **kwargs)
+        return
+
+    l_pids = []
+    sys.stdout.flush()
+    for _ in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(path_root, executable, fork, **kwargs)
+            finally:
+                os._exit(0)
+        l_pids.append(pid)
+    for pid in l_pids:
+        os.waitpid(pid, 0)
+
+
+# ==================================================================================================
+# --- Script for execution (pilot job)
+# ==================================================================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pilot worker running the jobs of a study")
+    parser.add_argument("path_root", help="Path of the study (root of the tree)")
+    parser.add_argument("executable", help="Name of the job executable in the job folders")
+    parser.add_argument("--n-workers", type=int, default=1)
+    parser.add_argument("--in-process", action="store_true", help="Do not fork for each job")
+    parser.add_argument("--max-time", type=float, default=None, help="No new job after (s)")
+    parser.add_argument("--pack-size", type=int, default=1, help="Jobs run at once by a worker")
+    args = parser.parse_args()
+
+    run_pilot(
+        args.path_root,
+        args.executable,
+        n_workers=args.n_workers,
+        fork=not args.in_process,
+        max_time=args.max_time,
+        pack_size=args.pack_size,
+    )
@@ -0,0 +1,80 @@
+"""This module contains the tools used to keep track of the status of all the nodes of a study in a
+single place. Each tag of a node (started, completed) is recorded as an empty file, named after the
+node and the tag, in the status index folder of the study. Creating a file is atomic, including on
+shared filesystems, and the status of all the nodes is read with a single listing of the folder,
+instead of reading the tree_maker log of each node. The same module is used by the jobs of
+generation 1 and generation 2 (to tag their node) and by the submission script (to query the
+status), and must be kept identical in the scripts folder and in both template folders."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import logging
+import os
+from urllib.parse import quote, unquote
+
+
+# ==================================================================================================
+# --- Functions to write the status index
+# ==================================================================================================
+def get_node_key(path_study, path_node):
+    # Nodes are identified by their path relative to the study (e.g. base_collider/xtrack_0000)
+    return os.path.relpath(path_node, path_study)
+
+
+def tag_status_index(path_index, path_node, tag):
+    # The index is only a summary of the tree_maker logs, failing to update it must not fail the
+    # job. Paths are resolved, as the job may not see the study through the same links as the tree
+    try:
+        key = get_node_key(
+            os.path.dirname(os.path.realpath(path_index)), os.path.realpath(path_node)
+        )
+        name = f"{quote(key, safe='')}.{tag}"
+        os.close(os.open(f"{path_index}/{name}", os.O_CREAT | os.O_WRONLY, 0o644))
+    except OSError as e:
+        logging.warning(f"Status index could not be updated: {e}")
+
+
+def rebuild_status_index(path_index, l_nodes, l_tags=("started", "completed")):
+    # Rebuild the index from the tree_maker logs of the nodes (slow, one read per node)
+    os.makedirs(path_index, exist_ok=True)
+    for node in l_nodes:
+        for tag in l_tags:
+            if node.has_been(tag):
+                tag_status_index(path_index, node.get_abs_path(), tag)
+
+
+# ==================================================================================================
+# --- Functions to query the status index
+# ==================================================================================================
+def read_status_index(path_index):
+    # Tags of all the nodes, from a single listing of the index folder
+    dic_node_to_tags = {}
+    for name in os.listdir(path_index):
+        key, _, tag = name.rpartition(".")
+        dic_node_to_tags.setdefault(unquote(key), set()).add(tag)
+    return dic_node_to_tags
+
+
+class StatusIndex:
+    def __init__(self, path_index):
+        self.path_index = path_index
+        # Paths are resolved as when the index is written, such that the keys match
+        self.path_study = os.path.dirname(os.path.realpath(path_index))
+        self.refresh()
+
+    def refresh(self):
+        self.dic_node_to_tags = read_status_index(self.path_index)
+
+    def has_been(self, path_node, tag):
+        key = get_node_key(self.path_study, os.path.realpath(path_node))
+        return key in self.dic_node_to_tags and tag in self.dic_node_to_tags[key]
+
+    def get_nodes(self, generation, tag):
+        # Nodes of the given generation (depth in the study) with the given tag
+        return [
+            key
+            for key, set_tags in self.dic_node_to_tags.items()
+            if tag in set_tags and len(key.split(os.sep)) == generation
+        ]
@@ -6,10 +6,12 @@ in this script are called sequentially."""
 # ==================================================================================================
 
 # Import standard library modules
+import hashlib
 import itertools
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZIP_DEFLATED, ZipFile
 
 # Import third-party modules
@@ -22,7 +24,10 @@ import tree_maker
 import xmask as xm
 import xmask.lhc as xlhc
 import yaml
+from base_collider_store import add_base_collider, fetch_base_collider, get_store_key
+from collider_io import check_collider_binary, save_collider_binary
 from cpymad.madx import Madx
+from status_index import tag_status_index
 
 
 # ==================================================================================================
@@ -32,6 +37,12 @@ def tree_maker_tagging(config, tag="started"):
     # Start tree_maker logging if log_file is present in config
     if tree_maker is not None and "log_file" in config:
         tree_maker.tag_json.tag_it(config["log_file"], tag)
+
+        # Also record the tag in the status index of the study, if any
+        if "status_index" in config and config["status_index"] is not None:
+            tag_status_index(
+                config["status_index"], os.path.dirname(os.path.abspath(config["log_file"])), tag
+            )
     else:
         logging.warning("tree_maker loging not available")
 
@@ -96,36 +107,44 @@ def write_particle_distribution(particle_list):
 # ==================================================================================================
 # --- Function to build collider from mad model
 # ==================================================================================================
-def build_collider_from_mad(config_mad, sanity_checks=True):
-    # Make mad environment
-    xm.make_mad_environment(links=config_mad["links"])
+def build_mad_sequence(mad, mylhcbeam, optics_file, sanity_checks=True):
+    # Build sequence
+    ost.build_sequence(mad, mylhcbeam=mylhcbeam)
+
+    # Apply optics (b4 will be generated from b1b2, its optics is applied just for check)
+    ost.apply_optics(mad, optics_file=optics_file)
+
+    if sanity_checks:
+        for sequence in ["lhcb1", "lhcb2"] if mylhcbeam == 1 else ["lhcb2"]:
+            mad.use(sequence=sequence)
+            mad.twiss()
+            ost.check_madx_lattices(mad)
+
+    return mad
+
 
+def build_collider_from_mad(config_mad, sanity_checks=True, parallel_mad_builds=True):
     # Start mad
     mad_b1b2 = Madx(command_log="mad_collider.log")
 
     mad_b4 = Madx(command_log="mad_b4.log")
 
-    # Build sequences
-    ost.build_sequence(mad_b1b2, mylhcbeam=1)
-    ost.build_sequence(mad_b4, mylhcbeam=4)
-
-    # Apply optics (only for b1b2, b4 will be generated from b1b2)
-    ost.apply_optics(mad_b1b2, optics_file=config_mad["optics_file"])
-
-    if sanity_checks:
-        mad_b1b2.use(sequence="lhcb1")
-        mad_b1b2.twiss()
-        ost.check_madx_lattices(mad_b1b2)
-        mad_b1b2.use(sequence="lhcb2")
-        mad_b1b2.twiss()
-        ost.check_madx_lattices(mad_b1b2)
-
-    # Apply optics (only for b4, just for check)
-    ost.apply_optics(mad_b4, optics_file=config_mad["optics_file"])
-    if sanity_checks:
-        mad_b4.use(sequence="lhcb2")
-        mad_b4.twiss()
-        ost.check_madx_lattices(mad_b4)
+    # Build sequences, apply optics and check them
+    # Each Madx instance runs in its own process, so the two builds can be driven concurrently
+    # from two threads (the GIL is released while waiting for the MAD-X processes)
+    l_args_build = [
+        (mad_b1b2, 1, config_mad["optics_file"], sanity_checks),
+        (mad_b4, 4, config_mad["optics_file"], sanity_checks),
+    ]
+    if parallel_mad_builds:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            l_futures = [executor.submit(build_mad_sequence, *args) for args in l_args_build]
+            # Propagate potential exceptions from the builds
+            for future in l_futures:
+                future.result()
+    else:
+        for args in l_args_build:
+            build_mad_sequence(*args)
 
     # Build xsuite collider
     collider = xlhc.build_xsuite_collider(
@@ -181,14 +200,60 @@ def activate_RF_and_twiss(collider, config_mad, sanity_checks=True):
 
 
 def clean():
-    # Remove all the temporaty files created in the process of building collider
-    os.remove("mad_collider.log")
-    os.remove("mad_b4.log")
+    # Remove all the temporaty files created in the process of building collider (mad logs don't
+    # exist if the collider has been retrieved from the store)
+    for path in ["mad_collider.log", "mad_b4.log"]:
+        if os.path.exists(path):
+            os.remove(path)
     shutil.rmtree("temp")
     os.unlink("errors")
     os.unlink("acc-models-lhc")
 
 
+def write_checksum(path, chunk_size=2**24):
+    # Compute the checksum by chunks to avoid loading the whole file in memory
+    sha = hashlib.sha256()
+    with open(path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b""):
+            sha.update(chunk)
+
+    # Write it alongside the file, such that generation 2 jobs don't have to recompute it
+    with open(f"{path}.sha256", "w") as fid:
+        fid.write(f"{sha.hexdigest()}  {os.path.basename(path)}\n")
+
+
+def build_base_collider(configuration, config_mad, sanity_checks=True):
+    # Build collider from mad model (b1/b2 and b4 sequences built concurrently by default)
+    parallel_mad_builds = (
+        configuration["parallel_mad_builds"] if "parallel_mad_builds" in configuration else True
+    )
+    collider = build_collider_from_mad(config_mad, sanity_checks, parallel_mad_builds)
+
+    # Twiss to ensure eveyrthing is ok
+    collider = activate_RF_and_twiss(collider, config_mad, sanity_checks)
+
+    # Clean temporary files
+    clean()
+
+    # Save collider to json
+    collider.to_json("collider.json")
+
+    # Compress the collider file to zip to ease the load on afs
+    with ZipFile("collider.json.zip", "w", ZIP_DEFLATED, compresslevel=9) as zipf:
+        zipf.write("collider.json")
+
+    # Write the checksum of the compressed collider (used to identify it in generation 2 caches)
+    write_checksum("collider.json.zip")
+
+    # Also save the collider in binary format if requested (faster to load in generation 2)
+    if "dump_collider_binary" in configuration and configuration["dump_collider_binary"]:
+        save_collider_binary(collider, "collider.bin")
+        check_collider_binary(collider, "collider.bin")
+        write_checksum("collider.bin")
+
+    return collider
+
+
 # ==================================================================================================
 # --- Main function for building distribution and collider
 # ==================================================================================================
@@ -208,21 +273,39 @@ def build_distr_and_collider(config_file="config.yaml"):
     # Write particle distribution to file
     write_particle_distribution(particle_list)
 
-    # Build collider from mad model
-    collider = build_collider_from_mad(config_mad, sanity_checks)
-
-    # Twiss to ensure eveyrthing is ok
-    collider = activate_RF_and_twiss(collider, config_mad, sanity_checks)
-
-    # Clean temporary files
-    clean()
+    # Make mad environment (also needed to identify the base collider in the global store)
+    xm.make_mad_environment(links=config_mad["links"])
 
-    # Save collider to json
-    collider.to_json("collider.json")
+    # Files requested by generation 2
+    l_files_collider = ["collider.json.zip", "collider.json.zip.sha256"]
+    if "dump_collider_binary" in configuration and configuration["dump_collider_binary"]:
+        l_files_collider += ["collider.bin", "collider.bin.sha256"]
 
-    # Compress the collider file to zip to ease the load on afs
-    with ZipFile("collider.json.zip", "w", ZIP_DEFLATED, compresslevel=9) as zipf:
-        zipf.write("collider.json")
+    # Look for an identical base collider in the global store (shared between studies)
+    path_store = (
+        configuration["base_collider_store"] if "base_collider_store" in configuration else None
+    )
+    if path_store is not None:
+        key_store = get_store_key(
+            config_mad,
+            [config_mad["optics_file"], *ost.L_SEQUENCE_FILES, "optics_specific_tools.py"],
+        )
+        if fetch_base_collider(path_store, key_store, l_files_collider):
+            clean()
+            tree_maker_tagging(configuration, tag="completed")
+            return
+
+    # Otherwise, build it
+    collider = build_base_collider(configuration, config_mad, sanity_checks)
+
+    # And add it to the store
+    if path_store is not None:
+        max_size_gb = (
+            configuration["base_collider_store_max_size_gb"]
+            if "base_collider_store_max_size_gb" in configuration
+            else None
+        )
+        add_base_collider(path_store, key_store, collider, config_mad, max_size_gb)
 
     # Tag end of the job
     tree_maker_tagging(configuration, tag="completed")
@@ -0,0 +1,178 @@
+"""This module contains the tools used to share base colliders between studies through a global
+store on disk. Each entry of the store is identified by a hash of the MAD configuration, of the
+files it refers to (optics, sequences) and of the versions of the packages used to build the
+collider, such that a base collider is only built once for a given set of inputs. The least
+recently used entries are evicted when the store exceeds a given size."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import copy
+import glob
+import os
+import re
+import shutil
+import socket
+import time
+from importlib.metadata import PackageNotFoundError, version
+
+# Import third-party modules
+import yaml
+
+# Import user-defined modules
+from collider_cache import (
+    get_dict_hash,
+    get_file_checksum,
+    get_path_tmp_entry,
+    publish_entry,
+)
+from collider_io import save_collider_binary
+
+# Packages whose version may change the base collider
+L_PACKAGES = ["cpymad", "xmask", "xtrack", "xpart", "xfields", "xobjects", "numpy"]
+
+
+# ==================================================================================================
+# --- Function to identify a base collider
+# ==================================================================================================
+def _get_package_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def get_store_key(config_mad, l_files):
+    # The links only point to the files, whose content is accounted for through their checksums
+    config_key = copy.deepcopy(config_mad)
+    del config_key["links"]
+
+    return get_dict_hash(
+        {
+            "config_mad": config_key,
+            "checksums": {path: get_file_checksum(path) for path in l_files},
+            "versions": {package: _get_package_version(package) for package in L_PACKAGES},
+        }
+    )
+
+
+# ==================================================================================================
+# --- Functions to read and write the store
+# ==================================================================================================
+def _link_or_copy(path_source, path_destination):
+    # Hard links cost no space, and keep the file alive even if the entry is evicted
+    if os.path.exists(path_destination):
+        os.remove(path_destination)
+    try:
+        os.link(path_source, path_destination)
+    except OSError:
+        shutil.copy2(path_source, path_destination)
+
+
+def _touch(path):
+    with open(path, "a"):
+        os.utime(path)
+
+
+def fetch_base_collider(path_store, key, l_files):
+    path_entry = f"{path_store}/{key}"
+    if not os.path.isdir(path_entry):
+        return False
+
+    try:
+        for file in l_files:
+            _link_or_copy(f"{path_entry}/{file}", file)
+        # Keep track of the last use of the entry for the eviction
+        _touch(f"{path_entry}/last_access")
+    except OSError:
+        # Entry evicted while being read, the collider must be built
+        print(f"Base collider {key} could not be retrieved from the store")
+        return False
+
+    print(f"Base collider {key} retrieved from the store")
+    return True
+
+
+def add_base_collider(path_store, key, collider, config_mad, max_size_gb=None):
+    os.makedirs(path_store, exist_ok=True)
+    path_entry = f"{path_store}/{key}"
+    if os.path.isdir(path_entry):
+        return
+
+    # Build the entry in a temporary folder. The binary collider is always stored, such that the
+    # entry can be used whatever the format requested by the next studies
+    path_tmp = get_path_tmp_entry(path_entry)
+    for file in ["collider.json.zip", "collider.json.zip.sha256"]:
+        shutil.copy2(file, f"{path_tmp}/{file}")
+    if os.path.isfile("collider.bin"):
+        shutil.copy2("collider.bin", f"{path_tmp}/collider.bin")
+    else:
+        save_collider_binary(collider, f"{path_tmp}/collider.bin")
+    checksum = get_file_checksum(f"{path_tmp}/collider.bin")
+    with open(f"{path_tmp}/collider.bin.sha256", "w") as fid:
+        fid.write(f"{checksum}  collider.bin\n")
+
+    # Keep the configuration for reference
+    with open(f"{path_tmp}/config_mad.yaml", "w") as fid:
+        yaml.dump(config_mad, fid)
+    _touch(f"{path_tmp}/last_access")
+
+    publish_entry(path_tmp, path_entry)
+    print(f"Base collider {key} added to the store")
+
+    # Make room if needed, never evicting the entry just added
+    if max_size_gb is not None:
+        evict_entries(path_store, max_size_gb * 1e9, l_keys_keep=[key])
+
+
+# ==================================================================================================
+# --- Functions to evict entries from the store
+# ==================================================================================================
+def _get_size(path):
+    return sum(
+        os.path.getsize(f"{dirpath}/{file}")
+        for dirpath, _, l_files in os.walk(path)
+        for file in l_files
+    )
+
+
+def _remove_entry(path_entry):
+    # Renaming first is atomic: other jobs never see a partially removed entry
+    path_trash = f"{path_entry}.trash.{socket.gethostname()}.{os.getpid()}"
+    try:
+        os.rename(path_entry, path_trash)
+    except OSError:
+        # Already removed by another job
+        return
+    shutil.rmtree(path_trash, ignore_errors=True)
+
+
+def evict_entries(path_store, max_size, l_keys_keep=(), timeout_tmp=86400):
+    # Remove leftovers from jobs that died while building or removing an entry
+    for path in glob.glob(f"{path_store}/*.tmp.*") + glob.glob(f"{path_store}/*.trash.*"):
+        if time.time() - os.path.getmtime(path) > timeout_tmp:
+            shutil.rmtree(path, ignore_errors=True)
+
+    # Get the size and last use of all the entries
+    l_entries = []
+    for path_entry in glob.glob(f"{path_store}/*"):
+        key = os.path.basename(path_entry)
+        if not re.fullmatch("[0-9a-f]{64}", key) or not os.path.isdir(path_entry):
+            continue
+        try:
+            last_access = os.path.getmtime(f"{path_entry}/last_access")
+        except FileNotFoundError:
+            last_access = os.path.getmtime(path_entry)
+        l_entries.append((last_access, key, _get_size(path_entry)))
+
+    # Evict the least recently used entries until the store fits in the allowed size
+    total_size = sum(size for _, _, size in l_entries)
+    for _, key, size in sorted(l_entries):
+        if total_size <= max_size:
+            break
+        if key in l_keys_keep:
+            continue
+        print(f"Evicting base collider {key} from the store")
+        _remove_entry(f"{path_store}/{key}")
+        total_size -= size
@@ -0,0 +1,97 @@
+"""This module contains the tools used to share colliders between jobs through a cache on disk.
+Cache entries are identified by a stable hash of their inputs, built in a temporary folder, and
+published with an atomic rename, such that several jobs can safely race to build the same entry.
+The same module is used in generation 1 and generation 2, and must be kept identical in both
+template folders."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+
+# ==================================================================================================
+# --- Functions to compute stable hashes
+# ==================================================================================================
+def get_file_checksum(path, chunk_size=2**24):
+    # Use the checksum written alongside the file (e.g. in generation 1) if it is up to date
+    path_checksum = f"{path}.sha256"
+    if os.path.isfile(path_checksum) and os.path.getmtime(path_checksum) >= os.path.getmtime(path):
+        with open(path_checksum, "r") as fid:
+            return fid.read().split()[0]
+
+    # Otherwise, compute it by chunks to avoid loading the whole file in memory
+    sha = hashlib.sha256()
+    with open(path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_dict_hash(dic):
+    # Keys are sorted so that the hash does not depend on the order in which they were defined
+    return hashlib.sha256(json.dumps(dic, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# ==================================================================================================
+# --- Functions to lock and publish cache entries
+# ==================================================================================================
+def try_acquire_lock(path_lock):
+    # Creating a directory is atomic, including on shared filesystems (AFS, EOS, NFS)
+    try:
+        os.mkdir(path_lock)
+    except FileExistsError:
+        return False
+
+    # Keep track of the owner of the lock for debugging purposes
+    with open(f"{path_lock}/owner", "w") as fid:
+        fid.write(f"{socket.gethostname()} {os.getpid()}\n")
+    return True
+
+
+def release_lock(path_lock):
+    shutil.rmtree(path_lock, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def local_file_lock(path_lock):
+    # Lock on a local filesystem only (flock is not reliable across hosts on shared filesystems),
+    # released automatically if the job dies
+    with open(path_lock, "a") as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+def is_lock_stale(path_lock, timeout):
+    try:
+        return time.time() - os.path.getmtime(path_lock) > timeout
+    except FileNotFoundError:
+        # Lock has been released in the meantime
+        return False
+
+
+def get_path_tmp_entry(path_entry):
+    # Temporary folder, unique to the current job, in which the entry is built before publication
+    path_tmp = f"{path_entry}.tmp.{socket.gethostname()}.{os.getpid()}"
+    os.makedirs(path_tmp, exist_ok=True)
+    return path_tmp
+
+
+def publish_entry(path_tmp, path_entry):
+    # Renaming is atomic: other jobs either see the complete entry, or no entry at all
+    try:
+        os.rename(path_tmp, path_entry)
+    except OSError:
+        # Another job published the same entry in the meantime, keep the existing one
+        shutil.rmtree(path_tmp, ignore_errors=True)
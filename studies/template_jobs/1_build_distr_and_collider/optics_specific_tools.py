@@ -1,7 +1,6 @@
 import numpy as np
 from xmask.lhc import install_errors_placeholders_hllhc
 
-
 def check_madx_lattices(mad):
     assert mad.globals["qxb1"] == mad.globals["qxb2"]
     assert mad.globals["qyb1"] == mad.globals["qyb2"]
@@ -35,6 +34,18 @@ def check_xsuite_lattices(my_line):
     print(tw.qx, tw.qy)
 
 
+# Files called when building the sequences. All the calls of build_sequence must go through this
+# dictionnary, as the list of files is also used to identify the base collider in the global store
+DIC_SEQUENCE_FILES = {
+    "lhc": "acc-models-lhc/lhc.seq",
+    "lhcb4": "acc-models-lhc/lhcb4.seq",
+    "hllhc": "acc-models-lhc/hllhc_sequence.madx",
+    "toolkit": "acc-models-lhc/toolkit/macro.madx",
+    "crab_cavities": "acc-models-lhc/toolkit/enable_crabcavities.madx",
+}
+L_SEQUENCE_FILES = list(DIC_SEQUENCE_FILES.values())
+
+
 def build_sequence(
     mad,
     mylhcbeam,
@@ -46,20 +57,20 @@ def build_sequence(
     mad.input(f"mylhcbeam = {mylhcbeam}")
 
     # Build sequence
-    mad.input("""
+    mad.input(f"""
       ! Build sequence
       option, -echo,-warn,-info;
-      if (mylhcbeam==4){
-        call,file="acc-models-lhc/lhcb4.seq";
-      } else {
-        call,file="acc-models-lhc/lhc.seq";
-      };
+      if (mylhcbeam==4){{
+        call,file="{DIC_SEQUENCE_FILES["lhcb4"]}";
+      }} else {{
+        call,file="{DIC_SEQUENCE_FILES["lhc"]}";
+      }};
       !Install HL-LHC
       call, file=
-        "acc-models-lhc/hllhc_sequence.madx";
+        "{DIC_SEQUENCE_FILES["hllhc"]}";
       ! Get the toolkit
       call,file=
-        "acc-models-lhc/toolkit/macro.madx";
+        "{DIC_SEQUENCE_FILES["toolkit"]}";
       option, -echo, warn,-info;
       """)
 
@@ -111,9 +122,9 @@ def build_sequence(
 
     # Incorporate crab-cavities
     if incorporate_CC:
-        mad.input("""
+        mad.input(f"""
         ! Install crab cavities (they are off)
-        call, file='acc-models-lhc/toolkit/enable_crabcavities.madx';
+        call, file='{DIC_SEQUENCE_FILES["crab_cavities"]}';
         on_crab1 = 0;
         on_crab5 = 0;
         """)
@@ -9,15 +9,23 @@ import contextlib
 # --- Imports
 # ==================================================================================================
 # Import standard library modules
+import copy
+import glob
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import sys
 import time
+from urllib.parse import quote
 from zipfile import ZipFile
 
 # Import third-party modules
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import ruamel.yaml
 import tree_maker
 
@@ -26,6 +34,19 @@ import xmask as xm
 import xmask.lhc as xlhc
 import xobjects as xo
 import xtrack as xt
+from collider_cache import (
+    get_dict_hash,
+    get_file_checksum,
+    get_path_tmp_entry,
+    is_lock_stale,
+    local_file_lock,
+    publish_entry,
+    release_lock,
+    try_acquire_lock,
+)
+from collider_io import load_collider_binary, save_collider_binary
+from kernel_cache import install_kernel_cache
+from knob_store import get_knob_values, get_nearest_knob_solution, write_knob_solution
 from misc import (
     compute_PU,
     generate_orbit_correction_setup,
@@ -34,6 +55,7 @@ from misc import (
     luminosity_leveling_ip1_5,
     return_fingerprint,
 )
+from status_index import tag_status_index
 
 # Initialize yaml reader
 ryaml = ruamel.yaml.YAML()
@@ -46,6 +68,12 @@ def tree_maker_tagging(config, tag="started"):
     # Start tree_maker logging if log_file is present in config
     if tree_maker is not None and "log_file" in config:
         tree_maker.tag_json.tag_it(config["log_file"], tag)
+
+        # Also record the tag in the status index of the study, if any
+        if "status_index" in config and config["status_index"] is not None:
+            tag_status_index(
+                config["status_index"], os.path.dirname(os.path.abspath(config["log_file"])), tag
+            )
     else:
         logging.warning("tree_maker loging not available")
 
@@ -99,6 +127,69 @@ def generate_configuration_correction_files(output_folder="correction"):
             json.dump(correction_setup[nn], fid, indent=4)
 
 
+# ==================================================================================================
+# --- Functions to load the base collider (zipped json, json, or binary file)
+# ==================================================================================================
+def populate_local_collider_cache(collider_file, path_entry):
+    # Build the entry in a temporary folder
+    path_tmp = get_path_tmp_entry(path_entry)
+    if collider_file.endswith(".bin"):
+        # Already in binary format, just copy it to the local disk
+        shutil.copyfile(collider_file, f"{path_tmp}/collider.bin")
+    else:
+        # Uncompress the file in the cache (not in the job folder), parse it, and save it in binary
+        # format such that the other jobs don't have to parse it again
+        if collider_file.endswith(".zip"):
+            with ZipFile(collider_file, "r") as zip_ref:
+                name_json = zip_ref.namelist()[0]
+                zip_ref.extract(name_json, path_tmp)
+            path_json = f"{path_tmp}/{name_json}"
+        else:
+            path_json = collider_file
+        save_collider_binary(xt.Multiline.from_json(path_json), f"{path_tmp}/collider.bin")
+        if path_json != collider_file:
+            os.remove(path_json)
+
+    # Make the entry visible to the other jobs
+    publish_entry(path_tmp, path_entry)
+
+
+def load_collider_from_local_cache(collider_file, path_local_cache):
+    # Entries are identified by the checksum of the collider file
+    path_local_cache = os.path.expanduser(os.path.expandvars(path_local_cache))
+    os.makedirs(path_local_cache, exist_ok=True)
+    path_entry = f"{path_local_cache}/{get_file_checksum(collider_file)}"
+
+    # Only one job per host populates the entry, the others wait for it
+    if not os.path.isdir(path_entry):
+        with local_file_lock(f"{path_entry}.lock"):
+            if not os.path.isdir(path_entry):
+                print(f"Populating local collider cache {path_entry}")
+                populate_local_collider_cache(collider_file, path_entry)
+
+    print(f"Loading collider from local cache {path_entry}")
+    return load_collider_binary(f"{path_entry}/collider.bin")
+
+
+def load_collider(collider_file, path_local_cache=None):
+    # Use the per-host cache of colliders if provided
+    if path_local_cache is not None:
+        return load_collider_from_local_cache(collider_file, path_local_cache)
+
+    if collider_file.endswith(".zip"):
+        # Uncompress file locally
+        with ZipFile(collider_file, "r") as zip_ref:
+            zip_ref.extractall()
+        collider = xt.Multiline.from_json(collider_file.split("/")[-1].replace(".zip", ""))
+    elif collider_file.endswith(".bin"):
+        # Map the binary file in memory
+        collider = load_collider_binary(collider_file)
+    else:
+        collider = xt.Multiline.from_json(collider_file)
+
+    return collider
+
+
 # ==================================================================================================
 # --- Function to install beam-beam
 # ==================================================================================================
@@ -137,11 +228,22 @@ def set_knobs(config_collider, collider):
     return collider, conf_knobs_and_tuning
 
 
-def match_tune_and_chroma(collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True):
+def match_tune_and_chroma(
+    collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True, knobs_warm_start=None
+):
     # Tunings
     for line_name in ["lhcb1", "lhcb2"]:
         knob_names = conf_knobs_and_tuning["knob_names"][line_name]
 
+        # Start matching from the knob values of a neighbouring working point if provided
+        # (coupling knobs are only set if linear coupling is being matched)
+        if knobs_warm_start is not None:
+            for knob_type, knob in knob_names.items():
+                if knob_type.startswith("c_minus") and not match_linear_coupling_to_zero:
+                    continue
+                if knob in knobs_warm_start:
+                    collider.vars[knob] = knobs_warm_start[knob]
+
         targets = {
             "qx": conf_knobs_and_tuning["qx"][line_name],
             "qy": conf_knobs_and_tuning["qy"][line_name],
@@ -489,6 +591,7 @@ def configure_collider(
     save_config=False,
     return_collider_before_bb=False,
     config_path="config.yaml",
+    path_knob_store=None,
 ):
     # Generate configuration files for orbit correction
     generate_configuration_correction_files()
@@ -497,16 +600,22 @@ def configure_collider(
     config_sim = config["config_simulation"]
     config_collider = config["config_collider"]
 
+    # Get the knobs of the nearest working point already solved, if a knob store is provided
+    # (the configuration is copied as it is mutated during the configuration of the collider).
+    # The result depends on the starting point, which is therefore recorded in the configuration
+    # (and thus in the output), None meaning that the knobs of the base collider were used
+    knobs_warm_start = {"before_leveling": None, "after_leveling": None}
+    if path_knob_store is not None:
+        config_collider_initial = copy.deepcopy(config_collider)
+        solution_nearest = get_nearest_knob_solution(path_knob_store, config_collider_initial)
+        config_collider["warm_start_targets"] = None
+        if solution_nearest is not None:
+            knobs_warm_start = solution_nearest["knobs"]
+            config_collider["warm_start_targets"] = solution_nearest["targets"]
+
     # Rebuild collider
-    if config_sim["collider_file"].endswith(".zip"):
-        # Uncompress file locally
-        with ZipFile(config_sim["collider_file"], "r") as zip_ref:
-            zip_ref.extractall()
-        collider = xt.Multiline.from_json(
-            config_sim["collider_file"].split("/")[-1].replace(".zip", "")
-        )
-    else:
-        collider = xt.Multiline.from_json(config_sim["collider_file"])
+    path_local_cache = config["local_cache_dir"] if "local_cache_dir" in config else None
+    collider = load_collider(config_sim["collider_file"], path_local_cache=path_local_cache)
 
     # Install beam-beam
     collider, config_bb = install_beam_beam(collider, config_collider)
@@ -521,8 +630,12 @@ def configure_collider(
 
     # Match tune and chromaticity
     collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True
+        collider,
+        conf_knobs_and_tuning,
+        match_linear_coupling_to_zero=True,
+        knobs_warm_start=knobs_warm_start["before_leveling"],
     )
+    knobs_before_leveling = get_knob_values(collider, conf_knobs_and_tuning)
 
     config_bb = set_filling_and_bunch_tracked(config_bb, ask_worst_bunch=False)
 
@@ -563,12 +676,26 @@ def configure_collider(
 
     # Rematch tune and chromaticity
     collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=False
+        collider,
+        conf_knobs_and_tuning,
+        match_linear_coupling_to_zero=False,
+        knobs_warm_start=knobs_warm_start["after_leveling"],
     )
 
     # Assert that tune, chromaticity and linear coupling are correct one last time
     assert_tune_chroma_coupling(collider, conf_knobs_and_tuning)
 
+    # Record the knobs solution for the next working points
+    if path_knob_store is not None:
+        write_knob_solution(
+            path_knob_store,
+            config_collider_initial,
+            {
+                "before_leveling": knobs_before_leveling,
+                "after_leveling": get_knob_values(collider, conf_knobs_and_tuning),
+            },
+        )
+
     # Return twiss and survey before beam-beam if requested
     collider_before_bb = None
     if return_collider_before_bb:
@@ -607,13 +734,152 @@ def configure_collider(
     return collider, config_sim, config_bb, collider_before_bb
 
 
+# ==================================================================================================
+# --- Functions to share the configured collider between jobs with the same collider configuration
+# ==================================================================================================
+def get_path_configured_collider_cache(config):
+    config_sim = config["config_simulation"]
+
+    # The cache is stored in the folder of the base collider (generation 1 node)
+    path_cache = (
+        f"{os.path.dirname(os.path.abspath(config_sim['collider_file']))}/configured_colliders"
+    )
+    os.makedirs(path_cache, exist_ok=True)
+
+    # Entries are identified by the collider configuration and the base collider file
+    key = get_dict_hash(
+        {
+            "config_collider": config["config_collider"],
+            "collider_file": get_file_checksum(config_sim["collider_file"]),
+        }
+    )
+    return f"{path_cache}/{key}"
+
+
+def write_configured_collider(path_entry, collider, config_collider):
+    # Write collider and updated configuration (e.g. after leveling) in a temporary folder
+    path_tmp = get_path_tmp_entry(path_entry)
+    save_collider_binary(collider, f"{path_tmp}/collider.bin")
+    with open(f"{path_tmp}/config_collider.yaml", "w") as fid:
+        ryaml.dump(config_collider, fid)
+
+    # Make the entry visible to the other jobs
+    publish_entry(path_tmp, path_entry)
+
+
+def load_configured_collider(
+    path_entry,
+    config,
+    config_mad,
+    save_collider=False,
+    save_config=False,
+    config_path="config.yaml",
+):
+    print(f"Loading configured collider from cache {path_entry}")
+    collider = load_collider_binary(f"{path_entry}/collider.bin")
+    collider.build_trackers()
+
+    # Update configuration as if the collider had been configured in this job
+    with open(f"{path_entry}/config_collider.yaml", "r") as fid:
+        config["config_collider"] = ryaml.load(fid)
+    with open(config_path, "w") as fid:
+        ryaml.dump(config, fid)
+
+    if save_collider:
+        print('Saving "collider_final.json')
+        if save_config:
+            collider.metadata = {
+                "config_mad": config_mad,
+                "config_collider": config["config_collider"],
+            }
+        collider.to_json("collider_final.json")
+
+    return (
+        collider,
+        config["config_simulation"],
+        config["config_collider"]["config_beambeam"],
+        None,
+    )
+
+
+def configure_collider_with_cache(
+    config,
+    config_mad,
+    context,
+    save_collider=False,
+    save_config=False,
+    config_path="config.yaml",
+    path_knob_store=None,
+    timeout_lock=3600,
+    time_poll=10,
+):
+    # Get the cache entry corresponding to the collider configuration
+    path_entry = get_path_configured_collider_cache(config)
+    path_lock = f"{path_entry}.lock"
+
+    # Wait for the entry to be published, unless it's the current job's turn to build it
+    while not os.path.isdir(path_entry):
+        if try_acquire_lock(path_lock):
+            try:
+                collider, config_sim, config_bb, _ = configure_collider(
+                    config,
+                    config_mad,
+                    context,
+                    save_collider=save_collider,
+                    save_config=save_config,
+                    config_path=config_path,
+                    path_knob_store=path_knob_store,
+                )
+                write_configured_collider(path_entry, collider, config["config_collider"])
+            finally:
+                release_lock(path_lock)
+            return collider, config_sim, config_bb, None
+
+        # The job building the entry probably died, configure the collider without the cache
+        if is_lock_stale(path_lock, timeout_lock):
+            print(f"Lock {path_lock} seems stale, configuring collider without cache")
+            return configure_collider(
+                config,
+                config_mad,
+                context,
+                save_collider=save_collider,
+                save_config=save_config,
+                config_path=config_path,
+                path_knob_store=path_knob_store,
+            )
+
+        time.sleep(time_poll)
+
+    return load_configured_collider(
+        path_entry,
+        config,
+        config_mad,
+        save_collider=save_collider,
+        save_config=save_config,
+        config_path=config_path,
+    )
+
+
+# ==================================================================================================
+# --- Function to get the store of knob solutions, used to warm-start the matching
+# ==================================================================================================
+def get_path_knob_store(config):
+    # The knob solutions are stored in the folder of the base collider (generation 1 node), as they
+    # are only relevant for the colliders built from it
+    path_collider = os.path.abspath(config["config_simulation"]["collider_file"])
+    return f"{os.path.dirname(path_collider)}/knob_solutions"
+
+
 # ==================================================================================================
 # --- Function to prepare particles distribution for tracking
 # ==================================================================================================
-def prepare_particle_distribution(collider, context, config_sim, config_bb):
+def prepare_particle_distribution(collider, context, config_sim, config_bb, particle_file=None):
     beam = config_sim["beam"]
 
-    particle_df = pd.read_parquet(config_sim["particle_file"])
+    # Default to the particle file of the configuration
+    if particle_file is None:
+        particle_file = config_sim["particle_file"]
+    particle_df = pd.read_parquet(particle_file)
 
     r_vect = particle_df["normalized amplitude in xy-plane"].values
     theta_vect = particle_df["angle in xy-plane [deg]"].values * np.pi / 180  # type: ignore # [rad]
@@ -633,24 +899,346 @@ def prepare_particle_distribution(collider, context, config_sim, config_bb):
     return particles, particle_id, r_vect, theta_vect
 
 
+# ==================================================================================================
+# --- Functions to search the DA boundary adaptively
+# ==================================================================================================
+# States given to the particles that are not tracked over all the turns in the adaptive search, as
+# they lie above a lost particle of the same angle (considered lost), or below the largest stable
+# particle of the same angle (considered stable, as any positive state)
+STATE_INFERRED_LOST = -1000
+STATE_INFERRED_STABLE = 1000
+
+# Status of the particles during the adaptive search
+STATUS_UNTRACKED = 0
+STATUS_STABLE = 1
+STATUS_STABLE_COARSE = 2
+STATUS_LOST = -1
+
+
+def _get_coarse_positions(n_amplitudes, n_coarse):
+    # Evenly spaced amplitudes, always including the smallest and largest ones
+    l_pos = np.linspace(0, n_amplitudes - 1, min(n_coarse, n_amplitudes))
+    return np.unique(l_pos.round().astype(int))
+
+
+def _get_boundary(l_status):
+    # Position of the smallest lost amplitude, and of the largest amplitude below it found stable
+    # over all the turns
+    l_pos_lost = np.flatnonzero(l_status == STATUS_LOST)
+    pos_lost = l_pos_lost[0] if len(l_pos_lost) > 0 else len(l_status)
+    l_pos_stable = np.flatnonzero(l_status[:pos_lost] == STATUS_STABLE)
+    pos_stable = l_pos_stable[-1] if len(l_pos_stable) > 0 else -1
+    return pos_stable, pos_lost
+
+
+def _get_refined_positions(l_status, n_refine):
+    # Evenly spaced amplitudes between the boundary amplitudes (all untracked, or only tracked in
+    # the coarse pass, by construction)
+    pos_stable, pos_lost = _get_boundary(l_status)
+    if pos_lost - pos_stable <= 1:
+        return np.array([], dtype=int)
+    l_pos = np.unique(np.linspace(pos_stable, pos_lost, n_refine + 2)[1:-1].round().astype(int))
+    return l_pos[(l_pos > pos_stable) & (l_pos < pos_lost)]
+
+
+def _track_subset(line, particles_cpu, context, mask, num_turns):
+    # Track the selected particles (from their current coordinates) and copy them back
+    particles_subset = particles_cpu.filter(mask)
+    if not isinstance(context, xo.ContextCpu):
+        particles_subset = particles_subset.copy(_context=context)
+    line.track(particles_subset, turn_by_turn_monitor=False, num_turns=num_turns)
+    if not isinstance(context, xo.ContextCpu):
+        particles_subset = particles_subset.copy(_context=xo.context_default)
+    particle_id = particles_subset.particle_id.copy()
+    with particles_cpu._bypass_linked_vars():
+        for _, name in particles_cpu.per_particle_vars:
+            getattr(particles_cpu, name)[particle_id] = getattr(particles_subset, name)
+    return particle_id, particles_subset.state > 0
+
+
+def track_adaptive(line, particles, config_sim, r_vect, theta_vect):
+    # Number of amplitudes tracked per angle in the coarse pass, and in each refinement round
+    n_coarse = config_sim["n_amplitudes_coarse"] if "n_amplitudes_coarse" in config_sim else 16
+    n_refine = config_sim["n_amplitudes_refine"] if "n_amplitudes_refine" in config_sim else 4
+    num_turns = config_sim["n_turns"]
+
+    # Number of turns of the coarse pass. Particles surviving it are only tracked over the
+    # remaining turns if they are needed to locate the boundary (all turns by default)
+    n_turns_coarse = num_turns
+    if "n_turns_coarse" in config_sim and config_sim["n_turns_coarse"]:
+        n_turns_coarse = min(config_sim["n_turns_coarse"], num_turns)
+
+    # Results are gathered in a copy of the particles on CPU (particle ids match the input order)
+    context = particles._buffer.context
+    if isinstance(context, xo.ContextCpu):
+        particles_cpu = particles
+    else:
+        particles_cpu = particles.copy(_context=xo.context_default)
+
+    # Indices of the particles of each angle, by increasing amplitude
+    l_idx_angles = []
+    for theta in np.unique(theta_vect):
+        idx_angle = np.flatnonzero(theta_vect == theta)
+        l_idx_angles.append(idx_angle[np.argsort(r_vect[idx_angle])])
+
+    # Status and number of turns tracked of each particle
+    status = np.full(len(r_vect), STATUS_UNTRACKED, dtype=int)
+    turns_done = np.zeros(len(r_vect), dtype=int)
+    l_positions = [_get_coarse_positions(len(idx_angle), n_coarse) for idx_angle in l_idx_angles]
+
+    # Track the selected amplitudes of all angles together, and refine around the boundaries
+    n_round = 0
+    n_turns_round = n_turns_coarse
+    elapsed_time = 0.0
+    particles_turns = 0
+    while any(len(l_pos) > 0 for l_pos in l_positions):
+        mask = np.zeros(len(r_vect), dtype=bool)
+        for idx_angle, l_pos in zip(l_idx_angles, l_positions):
+            mask[idx_angle[l_pos]] = True
+
+        # Particles only tracked in the coarse pass resume from where they stopped, such that the
+        # particles are tracked by groups having the same number of turns left
+        turns_left = n_turns_round - turns_done
+        for n_turns_left in np.unique(turns_left[mask]):
+            mask_group = mask & (turns_left == n_turns_left)
+            a = time.time()
+            particle_id, alive = _track_subset(
+                line, particles_cpu, context, mask_group, int(n_turns_left)
+            )
+            elapsed_time += time.time() - a
+            particles_turns += len(particle_id) * int(n_turns_left)
+            turns_done[particle_id] = n_turns_round
+            status[particle_id] = np.where(
+                alive,
+                STATUS_STABLE if n_turns_round == num_turns else STATUS_STABLE_COARSE,
+                STATUS_LOST,
+            )
+        print(
+            f"Adaptive DA search, round {n_round}: {np.sum(mask)} particles tracked up to turn"
+            f" {n_turns_round}"
+        )
+
+        l_positions = [
+            _get_refined_positions(status[idx_angle], n_refine) for idx_angle in l_idx_angles
+        ]
+        n_round += 1
+        n_turns_round = num_turns
+
+    # Particles that were not tracked over all the turns are considered lost above the boundary,
+    # and stable below it
+    for idx_angle in l_idx_angles:
+        _, pos_lost = _get_boundary(status[idx_angle])
+        mask_inferred = np.isin(status[idx_angle], [STATUS_UNTRACKED, STATUS_STABLE_COARSE])
+        particles_cpu.state[idx_angle[pos_lost:][mask_inferred[pos_lost:]]] = STATE_INFERRED_LOST
+        particles_cpu.state[idx_angle[:pos_lost][mask_inferred[:pos_lost]]] = STATE_INFERRED_STABLE
+
+    n_tracked = np.sum(status != STATUS_UNTRACKED)
+    print(f"Elapsed time: {elapsed_time} s")
+    print(f"Particles tracked: {n_tracked}/{len(status)} in {n_round} rounds")
+    print(f"Elapsed time per particle per turn: {elapsed_time/max(particles_turns, 1)*1e6} us")
+
+    if isinstance(context, xo.ContextCpu):
+        return particles_cpu
+    return particles_cpu.copy(_context=context)
+
+
+# ==================================================================================================
+# --- Functions to save and load tracking checkpoints
+# ==================================================================================================
+def get_path_checkpoint(config, output_file):
+    # Checkpoints are written in the node folder (and not in the scratch folder of HTCondor jobs),
+    # such that they survive an eviction of the job
+    path_node = os.path.dirname(os.path.abspath(config["log_file"]))
+    return f"{path_node}/checkpoint_{os.path.splitext(output_file)[0]}.npz"
+
+
+def get_checkpoint_key(config_sim, particle_file):
+    # The number of turns can be changed between two runs, the tracking is then just extended
+    config_key = {
+        key: value
+        for key, value in config_sim.items()
+        if key not in ["n_turns", "n_turns_checkpoint", "n_workers_chunks"]
+    }
+    return get_dict_hash({"config_simulation": config_key, "particle_file": particle_file})
+
+
+def write_checkpoint(path_checkpoint, particles, turns_done, key):
+    dic_particles = particles.to_dict(compact=True)
+
+    # Write to a temporary file first, such that a job evicted while writing doesn't corrupt it
+    path_tmp = f"{path_checkpoint}.tmp.{os.getpid()}"
+    with open(path_tmp, "wb") as fid:
+        np.savez(fid, checkpoint_turns_done=turns_done, checkpoint_key=key, **dic_particles)
+    os.replace(path_tmp, path_checkpoint)
+
+
+def load_checkpoint(path_checkpoint, key, context):
+    if not os.path.isfile(path_checkpoint):
+        return None, 0
+
+    try:
+        with np.load(path_checkpoint, allow_pickle=False) as data:
+            dic_particles = {name: data[name] for name in data.files}
+    except Exception:
+        logging.warning(f"Checkpoint {path_checkpoint} could not be read, tracking from scratch")
+        return None, 0
+
+    # Ignore checkpoints written for a different simulation
+    if str(dic_particles.pop("checkpoint_key")) != key:
+        logging.warning(f"Checkpoint {path_checkpoint} doesn't match the simulation, ignoring it")
+        return None, 0
+    turns_done = int(dic_particles.pop("checkpoint_turns_done"))
+
+    # Scalars are saved as 0-d arrays
+    dic_particles = {
+        name: value.item() if value.ndim == 0 else value for name, value in dic_particles.items()
+    }
+    return xt.Particles.from_dict(dic_particles, _context=context), turns_done
+
+
+# ==================================================================================================
+# --- Functions to track by blocks of turns (checkpoints and pruning of irrelevant particles)
+# ==================================================================================================
+# State given to the particles deactivated during the tracking, as a particle of lower amplitude has
+# been lost on the same angle (they are irrelevant for the DA, which is the smallest lost amplitude)
+STATE_PRUNED = -1001
+
+
+def prune_particles(particles, r_vect, theta_vect):
+    context = particles._buffer.context
+    state = context.nparray_from_context_array(particles.state).copy()
+    particle_id = context.nparray_from_context_array(particles.particle_id)
+
+    # Amplitude and angle of each particle (particles may have been reorganized during tracking)
+    mask_valid = particle_id >= 0
+    r_particles = np.full(len(state), np.inf)
+    theta_particles = np.full(len(state), np.nan)
+    r_particles[mask_valid] = r_vect[particle_id[mask_valid]]
+    theta_particles[mask_valid] = theta_vect[particle_id[mask_valid]]
+
+    # Deactivate the alive particles above the smallest lost amplitude of each angle
+    mask_lost = mask_valid & (state <= 0)
+    mask_prune = np.zeros(len(state), dtype=bool)
+    for theta in np.unique(theta_particles[mask_lost]):
+        mask_angle = theta_particles == theta
+        r_min_lost = np.min(r_particles[mask_lost & mask_angle])
+        mask_prune |= mask_angle & (state > 0) & (r_particles > r_min_lost)
+
+    if np.any(mask_prune):
+        state[mask_prune] = STATE_PRUNED
+        particles.state[:] = context.nparray_to_context_array(state)
+    return np.sum(mask_prune)
+
+
+def track_by_blocks(
+    line,
+    particles,
+    config_sim,
+    path_checkpoint=None,
+    key_checkpoint=None,
+    r_vect=None,
+    theta_vect=None,
+):
+    num_turns = config_sim["n_turns"]
+
+    # Checkpoints are written every n_turns_checkpoint turns, and particles are pruned every
+    # n_turns_pruning turns (if the corresponding features are requested)
+    n_turns_checkpoint = config_sim["n_turns_checkpoint"] if path_checkpoint is not None else None
+    n_turns_pruning = None
+    if r_vect is not None:
+        n_turns_pruning = config_sim["n_turns_pruning"] if "n_turns_pruning" in config_sim else 100
+    n_turns_block = min(n for n in [n_turns_checkpoint, n_turns_pruning] if n is not None)
+
+    # Resume from the last checkpoint if any
+    turns_done = 0
+    if path_checkpoint is not None:
+        particles_checkpoint, turns_done = load_checkpoint(
+            path_checkpoint, key_checkpoint, particles._buffer.context
+        )
+        if particles_checkpoint is not None:
+            print(f"Resuming tracking from turn {turns_done}")
+            particles = particles_checkpoint
+
+    # Track by blocks of turns
+    n_pruned = 0
+    while turns_done < num_turns:
+        n_turns_chunk = min(n_turns_block, num_turns - turns_done)
+        line.track(particles, turn_by_turn_monitor=False, num_turns=n_turns_chunk)
+        turns_done += n_turns_chunk
+
+        # Deactivate the particles that can't change the DA anymore
+        if n_turns_pruning is not None:
+            n_pruned += prune_particles(particles, r_vect, theta_vect)
+
+        # Save the particles if a checkpoint is due (always at the end of the tracking)
+        if n_turns_checkpoint is not None and (
+            turns_done // n_turns_checkpoint > (turns_done - n_turns_chunk) // n_turns_checkpoint
+            or turns_done == num_turns
+        ):
+            write_checkpoint(path_checkpoint, particles, turns_done, key_checkpoint)
+            print(f"Checkpoint written at turn {turns_done}")
+
+    if n_turns_pruning is not None:
+        print(f"Particles pruned during tracking: {n_pruned}")
+
+    return particles
+
+
 # ==================================================================================================
 # --- Function to do the tracking
 # ==================================================================================================
-def track(collider, particles, config_sim, save_input_particles=False):
+def track(
+    collider,
+    particles,
+    config_sim,
+    save_input_particles=False,
+    optimize_line=True,
+    r_vect=None,
+    theta_vect=None,
+    path_checkpoint=None,
+    key_checkpoint=None,
+):
     # Get beam being tracked
     beam = config_sim["beam"]
 
-    # Optimize line for tracking
-    collider[beam].optimize_for_tracking()
+    # Optimize line for tracking (only once if several chunks are tracked with the same line)
+    if optimize_line:
+        collider[beam].optimize_for_tracking()
 
     # Save initial coordinates if requested
     if save_input_particles:
         pd.DataFrame(particles.to_dict()).to_parquet("input_particles.parquet")
 
-    # Track
+    # Only track the particles needed to find the DA boundary of each angle if requested
+    # (checkpoints and pruning are not available in this mode)
+    prune = (
+        "prune_lost_amplitudes" in config_sim
+        and config_sim["prune_lost_amplitudes"]
+        and r_vect is not None
+    )
+    if "adaptive_da" in config_sim and config_sim["adaptive_da"] and r_vect is not None:
+        if path_checkpoint is not None or prune:
+            logging.warning(
+                "Checkpoints (n_turns_checkpoint) and pruning (prune_lost_amplitudes) are not"
+                " used with the adaptive DA search, ignoring them"
+            )
+        return track_adaptive(collider[beam], particles, config_sim, r_vect, theta_vect)
+
+    # Track, by blocks of turns if checkpoints or pruning of irrelevant particles are requested
     num_turns = config_sim["n_turns"]
     a = time.time()
-    collider[beam].track(particles, turn_by_turn_monitor=False, num_turns=num_turns)
+    if path_checkpoint is None and not prune:
+        collider[beam].track(particles, turn_by_turn_monitor=False, num_turns=num_turns)
+    else:
+        particles = track_by_blocks(
+            collider[beam],
+            particles,
+            config_sim,
+            path_checkpoint=path_checkpoint,
+            key_checkpoint=key_checkpoint,
+            r_vect=r_vect if prune else None,
+            theta_vect=theta_vect,
+        )
     b = time.time()
 
     print(f"Elapsed time: {b-a} s")
@@ -660,46 +1248,50 @@ def track(collider, particles, config_sim, save_input_particles=False):
 
 
 # ==================================================================================================
-# --- Main function for collider configuration and tracking
+# --- Functions to track one or several chunks of particles and save the corresponding output
 # ==================================================================================================
-def configure_and_track(config_path="config.yaml"):
-    # Get configuration
-    config_gen_1, config_gen_2 = read_configuration(config_path)
-
-    # Get context
-    context = get_context(config_gen_2)
-
-    # Tag start of the job
-    tree_maker_tagging(config_gen_2, tag="started")
-
-    # Configure collider (not saved, since it may trigger overload of afs)
-    collider, config_sim, config_bb, _ = configure_collider(
-        config_gen_2,
-        config_gen_1["config_mad"],
-        context,
-        save_collider=config_gen_2["dump_collider"],
-        save_config=config_gen_2["dump_config_in_collider"],
-        config_path=config_path,
-        return_collider_before_bb=False,
-    )
-
-    # Compute collider fingerprint
-    # (need to be done before tracking as collider can't be twissed after optimization)
-    fingerprint = return_fingerprint(config_sim["beam"], collider)
-    hash_fingerprint = hash(fingerprint)
+def get_particle_and_output_files(config_sim):
+    # A single chunk is tracked, the output layout is unchanged
+    if not os.path.isdir(config_sim["particle_file"]):
+        return [config_sim["particle_file"]], ["output_particles.parquet"]
+
+    # All the chunks of the folder are tracked, with one output file per chunk
+    l_particle_files = sorted(glob.glob(f"{config_sim['particle_file']}/*.parquet"))
+    l_output_files = [
+        f"output_particles_{os.path.basename(particle_file).split('.parquet')[0]}.parquet"
+        for particle_file in l_particle_files
+    ]
+    return l_particle_files, l_output_files
 
-    # Reset the tracker to go to GPU if needed
-    if config_gen_2["context"] in ["cupy", "opencl"]:
-        collider.discard_trackers()
-        collider.build_trackers(_context=context)
 
+def track_and_save_chunk(
+    collider,
+    context,
+    config_sim,
+    config_bb,
+    particle_file,
+    output_file,
+    dic_metadata,
+    optimize_line=True,
+    path_checkpoint=None,
+    dic_columns=None,
+):
     # Prepare particle distribution
     particles, particle_id, l_amplitude, l_angle = prepare_particle_distribution(
-        collider, context, config_sim, config_bb
+        collider, context, config_sim, config_bb, particle_file=particle_file
     )
 
     # Track
-    particles = track(collider, particles, config_sim)
+    particles = track(
+        collider,
+        particles,
+        config_sim,
+        optimize_line=optimize_line,
+        r_vect=l_amplitude,
+        theta_vect=l_angle,
+        path_checkpoint=path_checkpoint,
+        key_checkpoint=get_checkpoint_key(config_sim, particle_file),
+    )
 
     # Get particles dictionnary
     particles_dict = particles.to_dict()
@@ -718,15 +1310,290 @@ def configure_and_track(config_path="config.yaml"):
     particles_df["normalized amplitude in xy-plane"] = l_amplitude
     particles_df["angle in xy-plane [deg]"] = l_angle * 180 / np.pi
 
+    # Register the parameters of the job requested as columns (e.g. scanned parameters)
+    if dic_columns is not None:
+        for key, value in dic_columns.items():
+            particles_df[key] = value
+
     # Add some metadata to the output for better interpretability
-    particles_df.attrs["hash"] = hash_fingerprint
-    particles_df.attrs["fingerprint"] = fingerprint
-    particles_df.attrs["configuration_gen_1"] = config_gen_1
-    particles_df.attrs["configuration_gen_2"] = config_gen_2
+    for key, value in dic_metadata.items():
+        particles_df.attrs[key] = value
     particles_df.attrs["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
 
     # Save output
-    particles_df.to_parquet("output_particles.parquet")
+    particles_df.to_parquet(output_file)
+
+
+# Arguments shared with the worker processes (inherited through fork, as colliders can't be pickled)
+_shared_args_workers = None
+
+
+def _track_and_save_chunk_in_worker(particle_file, output_file, path_checkpoint):
+    collider, context, config_sim, config_bb, dic_metadata, dic_columns = _shared_args_workers
+    track_and_save_chunk(
+        collider,
+        context,
+        config_sim,
+        config_bb,
+        particle_file,
+        output_file,
+        dic_metadata,
+        optimize_line=False,
+        path_checkpoint=path_checkpoint,
+        dic_columns=dic_columns,
+    )
+
+
+def track_chunks(
+    collider,
+    context,
+    config_sim,
+    config_bb,
+    l_particle_files,
+    l_output_files,
+    dic_metadata,
+    n_workers=1,
+    l_checkpoint_files=None,
+    dic_columns=None,
+):
+    # No checkpoint by default
+    if l_checkpoint_files is None:
+        l_checkpoint_files = [None] * len(l_particle_files)
+
+    # Optimize line for tracking once for all the chunks
+    collider[config_sim["beam"]].optimize_for_tracking()
+
+    # Track the chunks in parallel in a local pool of processes (only possible on CPU)
+    if n_workers > 1 and len(l_particle_files) > 1:
+        if isinstance(context, xo.ContextCpu):
+            global _shared_args_workers
+            _shared_args_workers = (
+                collider,
+                context,
+                config_sim,
+                config_bb,
+                dic_metadata,
+                dic_columns,
+            )
+            with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+                pool.starmap(
+                    _track_and_save_chunk_in_worker,
+                    zip(l_particle_files, l_output_files, l_checkpoint_files),
+                )
+            _shared_args_workers = None
+            return
+        logging.warning("Chunks can only be tracked in parallel on CPU, tracking them sequentially")
+
+    # Track the chunks one after another
+    for particle_file, output_file, path_checkpoint in zip(
+        l_particle_files, l_output_files, l_checkpoint_files
+    ):
+        print(f"Tracking particles from {particle_file}")
+        track_and_save_chunk(
+            collider,
+            context,
+            config_sim,
+            config_bb,
+            particle_file,
+            output_file,
+            dic_metadata,
+            optimize_line=False,
+            path_checkpoint=path_checkpoint,
+            dic_columns=dic_columns,
+        )
+
+
+# ==================================================================================================
+# --- Functions to record the configuration of the job in the config table of the study
+# ==================================================================================================
+def write_config_table_entry(path_config_table, config_gen_1, config_gen_2, fingerprint):
+    # The particle file is not part of the entry, such that all the chunks of a working point
+    # share the same entry
+    config_gen_2 = copy.deepcopy(config_gen_2)
+    del config_gen_2["config_simulation"]["particle_file"]
+    dic_config = {
+        "configuration_gen_1": config_gen_1,
+        "configuration_gen_2": config_gen_2,
+        "fingerprint": fingerprint,
+    }
+
+    # Entries are identified by their hash, and only written once
+    hash_config = get_dict_hash(dic_config)
+    path_entry = f"{path_config_table}/{hash_config}.json"
+    if not os.path.isfile(path_entry):
+        path_tmp = get_path_tmp_entry(path_entry)
+        with open(f"{path_tmp}/entry.json", "w") as fid:
+            json.dump(dic_config, fid, default=str)
+        os.replace(f"{path_tmp}/entry.json", path_entry)
+        shutil.rmtree(path_tmp, ignore_errors=True)
+    return hash_config
+
+
+def get_parameters_in_output(config):
+    # Parameters of the collider configuration written as columns of the output
+    dic_parameters = {"beam": config["config_simulation"]["beam"]}
+    if "parameters_in_output" in config and config["parameters_in_output"] is not None:
+        for name_param, l_path_param in config["parameters_in_output"].items():
+            value = config["config_collider"]
+            for key in l_path_param:
+                value = value[key]
+            dic_parameters[name_param] = value
+    return dic_parameters
+
+
+# ==================================================================================================
+# --- Function to publish the output of the job in the results dataset of the study
+# ==================================================================================================
+def publish_to_results_dataset(config, output_file):
+    # The dataset is partitioned (hive layout) by beam, base collider and scanned parameters
+    dic_parameters = get_parameters_in_output(config)
+    dic_partitions = {
+        "beam": dic_parameters["beam"],
+        "base_collider": os.path.basename(os.path.dirname(os.getcwd())),
+    }
+    if "results_partitioning" in config and config["results_partitioning"] is not None:
+        for name_param in config["results_partitioning"]:
+            dic_partitions[name_param] = dic_parameters[name_param]
+    path_partition = "/".join(
+        [config["results_dataset"]]
+        + [f"{key}={quote(str(value), safe='')}" for key, value in dic_partitions.items()]
+    )
+    os.makedirs(path_partition, exist_ok=True)
+
+    # Partition values are only stored in the path, the other parameters are stored as columns
+    # (the configuration in the attributes is not copied, all the files sharing the same schema)
+    particles_df = pd.read_parquet(output_file)
+    particles_df = particles_df.drop(columns=list(dic_partitions), errors="ignore")
+    for name_param, value in dic_parameters.items():
+        if name_param not in dic_partitions:
+            particles_df[name_param] = value
+    table = pa.Table.from_pandas(particles_df, preserve_index=False).replace_schema_metadata(None)
+
+    # One file per job and chunk, written in a temporary file first (ignored by the readers)
+    name_file = f"{os.path.basename(os.getcwd())}_{output_file}"
+    path_tmp = f"{path_partition}/.{name_file}.tmp.{os.getpid()}"
+    pq.write_table(table, path_tmp)
+    os.replace(path_tmp, f"{path_partition}/{name_file}")
+
+
+# ==================================================================================================
+# --- Main functions for collider configuration and tracking
+# ==================================================================================================
+def configure(config_path="config.yaml", context=None):
+    # Get configuration
+    config_gen_1, config_gen_2 = read_configuration(config_path)
+
+    # Get context
+    if context is None:
+        context = get_context(config_gen_2)
+
+    # Tag start of the job
+    tree_maker_tagging(config_gen_2, tag="started")
+
+    # If requested, load the tracking kernels already compiled by other jobs (and share the ones
+    # compiled by this job)
+    if "kernel_cache" in config_gen_2 and config_gen_2["kernel_cache"] is not None:
+        install_kernel_cache(config_gen_2["kernel_cache"])
+
+    # If requested, start the matching from the knobs of the nearest working point already solved
+    path_knob_store = None
+    if "warm_start_matching" in config_gen_2 and config_gen_2["warm_start_matching"]:
+        path_knob_store = get_path_knob_store(config_gen_2)
+
+    # Configure collider (not saved, since it may trigger overload of afs)
+    # If requested, the configured collider is shared with the other jobs of the same working point
+    if "cache_configured_collider" in config_gen_2 and config_gen_2["cache_configured_collider"]:
+        collider, config_sim, config_bb, _ = configure_collider_with_cache(
+            config_gen_2,
+            config_gen_1["config_mad"],
+            context,
+            save_collider=config_gen_2["dump_collider"],
+            save_config=config_gen_2["dump_config_in_collider"],
+            config_path=config_path,
+            path_knob_store=path_knob_store,
+        )
+    else:
+        collider, config_sim, config_bb, _ = configure_collider(
+            config_gen_2,
+            config_gen_1["config_mad"],
+            context,
+            save_collider=config_gen_2["dump_collider"],
+            save_config=config_gen_2["dump_config_in_collider"],
+            config_path=config_path,
+            return_collider_before_bb=False,
+            path_knob_store=path_knob_store,
+        )
+
+    # Compute collider fingerprint
+    # (need to be done before tracking as collider can't be twissed after optimization)
+    fingerprint = return_fingerprint(config_sim["beam"], collider)
+
+    return config_gen_1, config_gen_2, collider, config_sim, config_bb, fingerprint
+
+
+def track_and_save(
+    config_gen_1, config_gen_2, collider, context, config_sim, config_bb, fingerprint
+):
+    # Reset the tracker to go to GPU if needed
+    if config_gen_2["context"] in ["cupy", "opencl"]:
+        collider.discard_trackers()
+        collider.build_trackers(_context=context)
+
+    # Get the particle chunks to track, and the corresponding output files
+    l_particle_files, l_output_files = get_particle_and_output_files(config_sim)
+
+    # Add some metadata to the output for better interpretability. If the study has a config
+    # table, the configuration is written there once for all the jobs sharing it, and the output
+    # only keeps its hash, along with the requested parameters as columns
+    dic_columns = None
+    if "config_table" in config_gen_2 and config_gen_2["config_table"] is not None:
+        hash_config = write_config_table_entry(
+            config_gen_2["config_table"], config_gen_1, config_gen_2, fingerprint
+        )
+        dic_metadata = {"hash_config": hash_config}
+        dic_columns = get_parameters_in_output(config_gen_2)
+        dic_columns["hash_config"] = hash_config
+    else:
+        dic_metadata = {
+            "hash": hash(fingerprint),
+            "fingerprint": fingerprint,
+            "configuration_gen_1": config_gen_1,
+            "configuration_gen_2": config_gen_2,
+        }
+
+    # If requested, track by chunks of turns, saving checkpoints from which the tracking is
+    # resumed if the job is restarted
+    l_checkpoint_files = None
+    if "n_turns_checkpoint" in config_sim and config_sim["n_turns_checkpoint"]:
+        l_checkpoint_files = [
+            get_path_checkpoint(config_gen_2, output_file) for output_file in l_output_files
+        ]
+
+    # Track all the chunks with the same collider
+    n_workers = config_sim["n_workers_chunks"] if "n_workers_chunks" in config_sim else 1
+    track_chunks(
+        collider,
+        context,
+        config_sim,
+        config_bb,
+        l_particle_files,
+        l_output_files,
+        dic_metadata,
+        n_workers=n_workers,
+        l_checkpoint_files=l_checkpoint_files,
+        dic_columns=dic_columns,
+    )
+
+    # Publish the outputs in the results dataset of the study if any
+    if "results_dataset" in config_gen_2 and config_gen_2["results_dataset"] is not None:
+        for output_file in l_output_files:
+            publish_to_results_dataset(config_gen_2, output_file)
+
+    # Checkpoints are not needed anymore once all the outputs are written
+    if l_checkpoint_files is not None:
+        for path_checkpoint in l_checkpoint_files:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path_checkpoint)
 
     # Remove the correction folder, and potential C files remaining
     with contextlib.suppress(Exception):
@@ -736,9 +1603,97 @@ def configure_and_track(config_path="config.yaml"):
     tree_maker_tagging(config_gen_2, tag="completed")
 
 
+def configure_and_track(config_path="config.yaml"):
+    config_gen_1, config_gen_2, collider, config_sim, config_bb, fingerprint = configure(
+        config_path
+    )
+    track_and_save(
+        config_gen_1,
+        config_gen_2,
+        collider,
+        get_context(config_gen_2),
+        config_sim,
+        config_bb,
+        fingerprint,
+    )
+
+
+# ==================================================================================================
+# --- Functions to configure and track several nodes in the same job (GPU packing)
+#
+# The colliders of several nodes are configured on the CPU, in a pool of processes, while the
+# colliders already configured are tracked one after the other on the GPU (with the same context,
+# such that kernels are only compiled once). The outputs are written in each node folder as usual.
+# Note that only the overhead of the jobs is shared (startup, environment, collider configuration
+# overlapping with tracking, kernel compilation, GPU requests): each node is still tracked on its
+# own, with its own number of particles, such that a GPU undersaturated by the chunk of a single
+# node stays undersaturated while tracking it. The particles of different nodes can't be merged in
+# a single batch, as the nodes generally have different colliders (e.g. tunes in a scan).
+# ==================================================================================================
+def _configure_node_in_worker(path_node):
+    # Configure the collider of the node on the CPU, and hand it over through a binary file, as
+    # colliders can't be pickled
+    try:
+        os.chdir(path_node)
+        _, _, collider, _, _, fingerprint = configure(context=xo.ContextCpu())
+        save_collider_binary(collider, "collider_packed.bin")
+        return path_node, fingerprint
+    except Exception:
+        logging.exception(f"Configuration of node {path_node} failed")
+        return path_node, None
+
+
+def configure_and_track_packed(l_path_nodes, n_workers=None):
+    # The pool must be started before the GPU context is created (CUDA does not support fork)
+    if n_workers is None:
+        n_workers = max(1, len(os.sched_getaffinity(0)) - 1)
+    n_workers = min(n_workers, len(l_path_nodes))
+    l_failed_nodes = []
+    with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+        context = None
+        for path_node, fingerprint in pool.imap(_configure_node_in_worker, l_path_nodes):
+            if fingerprint is None:
+                l_failed_nodes.append(path_node)
+                continue
+
+            # Track the configured collider on the GPU (the configuration has been updated by the
+            # worker, e.g. after leveling)
+            try:
+                os.chdir(path_node)
+                print(f"Tracking node {path_node}")
+                config_gen_1, config_gen_2 = read_configuration()
+                if context is None:
+                    if "kernel_cache" in config_gen_2 and config_gen_2["kernel_cache"] is not None:
+                        install_kernel_cache(config_gen_2["kernel_cache"])
+                    context = get_context(config_gen_2)
+                collider = load_collider_binary("collider_packed.bin")
+                collider.build_trackers()
+                os.remove("collider_packed.bin")
+                track_and_save(
+                    config_gen_1,
+                    config_gen_2,
+                    collider,
+                    context,
+                    config_gen_2["config_simulation"],
+                    config_gen_2["config_collider"]["config_beambeam"],
+                    fingerprint,
+                )
+            except Exception:
+                logging.exception(f"Tracking of node {path_node} failed")
+                l_failed_nodes.append(path_node)
+
+    # The nodes that failed are not tagged as completed, and are submitted again later
+    if l_failed_nodes:
+        raise RuntimeError(f"Packed job failed for the nodes: {', '.join(l_failed_nodes)}")
+
+
 # ==================================================================================================
 # --- Script for execution
 # ==================================================================================================
 
 if __name__ == "__main__":
-    configure_and_track()
+    # Several node folders may be given to configure and track them in the same job (GPU packing)
+    if len(sys.argv) > 1:
+        configure_and_track_packed(sys.argv[1:])
+    else:
+        configure_and_track()
@@ -0,0 +1,189 @@
+"""This module contains the tools used to save and load colliders in a binary format. The numerical
+data of the elements is stored by element type and field, as typed contiguous buffers, while the
+rest of the collider (index of the buffers, variables, expressions, etc.) is stored in a json
+header. Loading maps the file in memory (np.memmap), such that no decompression and no parsing of
+the element data is needed. Note that the element data is still copied when the collider is
+rebuilt (xt.Multiline.from_dict allocates its own buffers), the gain is only on reading and
+decoding the file. The same module is used in generation 1 (to save the collider) and generation
+2 (to load it), and must be kept identical in both template folders."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import json
+import numbers
+import os
+
+# Import third-party modules
+import numpy as np
+import xtrack as xt
+from xobjects import JEncoder
+
+# Identifier of the format, and alignment of the buffers in the file (in bytes)
+MAGIC = b"XCOLBIN2"
+ALIGNMENT = 64
+
+
+# ==================================================================================================
+# --- Functions to convert the elements of a line into buffers
+# ==================================================================================================
+def _is_scalar(value):
+    return isinstance(value, (numbers.Number, np.bool_)) and not isinstance(value, complex)
+
+
+def _get_column(l_values):
+    # Column of scalars
+    if all(_is_scalar(value) for value in l_values):
+        if all(isinstance(value, (bool, np.bool_)) for value in l_values):
+            return np.asarray(l_values, dtype=np.bool_)
+        if all(isinstance(value, (numbers.Integral, np.integer)) for value in l_values):
+            return np.asarray(l_values, dtype=np.int64)
+        return np.asarray(l_values, dtype=np.float64)
+
+    # Column of numerical arrays of the same shape
+    if all(isinstance(value, (list, tuple, np.ndarray)) for value in l_values):
+        try:
+            l_arrays = [np.asarray(value) for value in l_values]
+        except ValueError:
+            return None
+        if (
+            len({array.shape for array in l_arrays}) == 1
+            and all(array.dtype.kind in "biuf" for array in l_arrays)
+            and l_arrays[0].size > 0
+        ):
+            return np.stack(l_arrays)
+
+    # Anything else (strings, nested dictionnaries, ragged arrays) is kept in the header
+    return None
+
+
+def _names_to_buffer(l_names):
+    # Each name is terminated by a null character, such that empty names are kept
+    return np.frombuffer("".join(f"{name}\0" for name in l_names).encode("utf-8"), dtype=np.uint8)
+
+
+def _buffer_to_names(buffer):
+    return bytes(buffer).decode("utf-8").split("\0")[:-1]
+
+
+def _elements_to_groups(elements, l_arrays):
+    # Group elements by type and set of fields, such that each field can be stored as a column
+    dic_groups = {}
+    for name, element in elements.items():
+        key = (element["__class__"], tuple(sorted(element.keys())))
+        dic_groups.setdefault(key, []).append(name)
+
+    l_groups = []
+    for (_, fields), l_names in dic_groups.items():
+        group = {"names": len(l_arrays), "fields": {}}
+        l_arrays.append(_names_to_buffer(l_names))
+        for field in fields:
+            l_values = [elements[name][field] for name in l_names]
+            column = None if field == "__class__" else _get_column(l_values)
+            if column is None:
+                group["fields"][field] = {"values": l_values}
+            else:
+                group["fields"][field] = {"array": len(l_arrays)}
+                l_arrays.append(column)
+        l_groups.append(group)
+
+    return l_groups
+
+
+def _groups_to_elements(l_groups, get_array):
+    elements = {}
+    for group in l_groups:
+        l_names = _buffer_to_names(get_array(group["names"]))
+
+        # Scalars are converted to python objects, arrays are kept as views of the mapped file
+        # (they are only read, and copied, when the elements are built)
+        dic_columns = {}
+        for field, column in group["fields"].items():
+            if "values" in column:
+                dic_columns[field] = column["values"]
+            else:
+                array = get_array(column["array"])
+                dic_columns[field] = array.tolist() if array.ndim == 1 else array
+
+        for idx, name in enumerate(l_names):
+            elements[name] = {field: column[idx] for field, column in dic_columns.items()}
+
+    return elements
+
+
+# ==================================================================================================
+# --- Functions to save and load the collider
+# ==================================================================================================
+def save_collider_binary(collider, path):
+    dic_collider = collider.to_dict()
+
+    # Replace the elements and element names of each line by references to buffers
+    l_arrays = []
+    for line in dic_collider["lines"].values():
+        line["element_groups"] = _elements_to_groups(line.pop("elements"), l_arrays)
+        l_element_names = line.pop("element_names")
+        line["element_names"] = {"array": len(l_arrays)}
+        l_arrays.append(_names_to_buffer(l_element_names))
+
+    # Compute the position of each buffer in the file
+    l_index = []
+    offset = 0
+    for array in l_arrays:
+        array = np.ascontiguousarray(array)
+        l_index.append({"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)})
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    # Header (offsets are relative to the start of the data section)
+    header = json.dumps({"collider": dic_collider, "arrays": l_index}, cls=JEncoder).encode()
+    size_header = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    # Write to a temporary file first, such that the file is never seen partially written
+    path_tmp = f"{path}.tmp.{os.getpid()}"
+    with open(path_tmp, "wb") as fid:
+        fid.write(MAGIC)
+        fid.write(len(header).to_bytes(8, "little"))
+        fid.write(header)
+        fid.write(b"\0" * (size_header - len(MAGIC) - 8 - len(header)))
+        for array in l_arrays:
+            data = np.ascontiguousarray(array).tobytes()
+            fid.write(data)
+            fid.write(b"\0" * (-(-len(data) // ALIGNMENT) * ALIGNMENT - len(data)))
+    os.replace(path_tmp, path)
+
+
+def load_collider_binary(path):
+    # Read the header
+    with open(path, "rb") as fid:
+        if fid.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a binary collider file")
+        len_header = int.from_bytes(fid.read(8), "little")
+        header = json.loads(fid.read(len_header))
+    size_header = -(-(len(MAGIC) + 8 + len_header) // ALIGNMENT) * ALIGNMENT
+
+    # Map the data section in memory, buffers are only read when accessed
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=size_header)
+
+    def get_array(idx):
+        info = header["arrays"][idx]
+        dtype = np.dtype(info["dtype"])
+        nbytes = int(np.prod(info["shape"], dtype=np.int64)) * dtype.itemsize
+        return data[info["offset"] : info["offset"] + nbytes].view(dtype).reshape(info["shape"])
+
+    # Rebuild the dictionnary of the collider
+    dic_collider = header["collider"]
+    for line in dic_collider["lines"].values():
+        line["elements"] = _groups_to_elements(line.pop("element_groups"), get_array)
+        line["element_names"] = _buffer_to_names(get_array(line["element_names"]["array"]))
+
+    return xt.Multiline.from_dict(dic_collider)
+
+
+def check_collider_binary(collider, path):
+    # Check that the collider loaded from the binary file is identical to the one saved, as it
+    # would be after a round trip through json
+    collider_loaded = load_collider_binary(path)
+    json_ref = json.dumps(collider.to_dict(), cls=JEncoder, sort_keys=True)
+    json_loaded = json.dumps(collider_loaded.to_dict(), cls=JEncoder, sort_keys=True)
+    if json_loaded != json_ref:
+        raise ValueError(f"The collider loaded from {path} differs from the one saved")
@@ -0,0 +1,126 @@
+"""This module contains the tools used to share the compiled tracking kernels of xtrack between
+jobs, through a cache on disk. Kernels are identified by a stable hash of their specialized C
+source (which depends on the element classes and on the configuration of the tracker), of the
+context, and of the platform and packages used to compile them. The first job needing a kernel
+compiles it while the others wait, and all the following jobs load the compiled library instead of
+compiling it again."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import glob
+import os
+import shutil
+import sysconfig
+import time
+from importlib.metadata import version
+
+# Import third-party modules
+import xobjects as xo
+import xtrack as xt
+
+# Import user-defined modules
+from collider_cache import (
+    get_dict_hash,
+    get_path_tmp_entry,
+    is_lock_stale,
+    release_lock,
+    try_acquire_lock,
+)
+
+# Packages whose version may change the compiled kernels
+L_PACKAGES = ["xobjects", "xtrack", "xpart", "xfields", "cffi"]
+
+# Original method of xtrack building the tracking kernels
+_build_kernel = xt.Tracker._build_kernel
+
+
+# ==================================================================================================
+# --- Functions to build the kernels through the cache
+# ==================================================================================================
+def get_kernel_key(kernel, context):
+    return get_dict_hash(
+        {
+            "source": kernel.specialized_source,
+            "openmp": context.openmp_enabled,
+            "platform": sysconfig.get_platform(),
+            "soabi": sysconfig.get_config_var("SOABI"),
+            "versions": {package: version(package) for package in L_PACKAGES},
+        }
+    )
+
+
+def build_kernel_with_cache(tracker, path_kernel_cache, timeout_lock=1800, time_poll=1):
+    # Generate the sources only, to identify the kernel (already compiled kernels distributed
+    # with xsuite are returned as they are)
+    kernel = _build_kernel(tracker, compile=False)
+    if kernel.function is not None:
+        return kernel
+    context = tracker._context
+    module_name = f"track_line_{get_kernel_key(kernel, context)[:32]}"
+    path_lock = f"{path_kernel_cache}/{module_name}.lock"
+
+    # Wait for the kernel to be compiled, unless it's the current job's turn to compile it
+    while not glob.glob(f"{path_kernel_cache}/{module_name}.*so"):
+        if try_acquire_lock(path_lock):
+            try:
+                # Compile in a temporary folder, then move the library to the cache, such that the
+                # other jobs never load a partially written library
+                print(f"Compiling kernel {module_name}")
+                path_tmp = get_path_tmp_entry(f"{path_kernel_cache}/{module_name}")
+                kernel = _build_kernel(
+                    tracker, compile=True, module_name=module_name, containing_dir=path_tmp
+                )
+                for path_so in glob.glob(f"{path_tmp}/{module_name}.*so"):
+                    os.replace(path_so, f"{path_kernel_cache}/{os.path.basename(path_so)}")
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            finally:
+                release_lock(path_lock)
+            return kernel
+
+        # The job compiling the kernel probably died, compile it without the cache
+        if is_lock_stale(path_lock, timeout_lock):
+            print(f"Lock {path_lock} seems stale, compiling kernel without cache")
+            return _build_kernel(tracker, compile=True)
+
+        time.sleep(time_poll)
+
+    print(f"Loading kernel {module_name} from cache")
+    return context.kernels_from_file(
+        module_name=module_name,
+        kernel_descriptions={"track_line": kernel.description},
+        containing_dir=path_kernel_cache,
+    )["track_line"]
+
+
+def install_kernel_cache(path_kernel_cache):
+    # All the tracking kernels compiled for the CPU in this process go through the cache (kernels
+    # with extra classes or extra kernels are specific to a given computation, and built as usual)
+    path_kernel_cache = os.path.expanduser(os.path.expandvars(path_kernel_cache))
+    os.makedirs(path_kernel_cache, exist_ok=True)
+
+    def _build_kernel_with_cache(
+        self, compile, module_name=None, containing_dir=".", extra_classes=[], extra_kernels={}
+    ):
+        if (
+            compile is True
+            and module_name is None
+            and not extra_classes
+            and not extra_kernels
+            and isinstance(self._context, xo.ContextCpu)
+        ):
+            return build_kernel_with_cache(self, path_kernel_cache)
+        return _build_kernel(
+            self,
+            compile,
+            module_name=module_name,
+            containing_dir=containing_dir,
+            extra_classes=extra_classes,
+            extra_kernels=extra_kernels,
+        )
+
+    xt.Tracker._build_kernel = _build_kernel_with_cache
+
+    # Kernels compiled for GPUs are cached by CuPy, in the same folder
+    os.environ["CUPY_CACHE_DIR"] = f"{path_kernel_cache}/cupy"
@@ -0,0 +1,100 @@
+"""This module contains the tools used to store the tune, chromaticity and coupling knob values
+obtained after matching each working point, such that new jobs can start matching from the
+solution of the nearest working point already solved."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+# Import standard library modules
+import copy
+import glob
+import json
+import logging
+import os
+
+# Import user-defined modules
+from collider_cache import get_dict_hash
+
+# Keys of the tuning targets, and weight used to compare them (chromaticity steps are about three
+# orders of magnitude larger than tune steps in a typical scan)
+DIC_WEIGHT_TARGETS = {"qx": 1.0, "qy": 1.0, "dqx": 1e-3, "dqy": 1e-3}
+
+
+# ==================================================================================================
+# --- Functions to identify a working point
+# ==================================================================================================
+def get_targets(config_collider):
+    conf_knobs_and_tuning = config_collider["config_knobs_and_tuning"]
+    return {
+        line_name: {key: float(conf_knobs_and_tuning[key][line_name]) for key in DIC_WEIGHT_TARGETS}
+        for line_name in ["lhcb1", "lhcb2"]
+    }
+
+
+def get_context_hash(config_collider):
+    # Hash of the collider configuration, excluding the tuning targets (i.e. all the working
+    # points of a scan share the same context)
+    config_context = json.loads(json.dumps(config_collider, default=str))
+    for key in DIC_WEIGHT_TARGETS:
+        del config_context["config_knobs_and_tuning"][key]
+    return get_dict_hash(config_context)
+
+
+def _get_distance(targets_1, targets_2):
+    return sum(
+        (weight * (targets_1[line_name][key] - targets_2[line_name][key])) ** 2
+        for line_name in targets_1
+        for key, weight in DIC_WEIGHT_TARGETS.items()
+    )
+
+
+# ==================================================================================================
+# --- Functions to read and write the knob solutions
+# ==================================================================================================
+def get_knob_values(collider, conf_knobs_and_tuning):
+    return {
+        knob: float(collider.vars[knob]._value)
+        for line_name in ["lhcb1", "lhcb2"]
+        for knob in conf_knobs_and_tuning["knob_names"][line_name].values()
+    }
+
+
+def write_knob_solution(path_store, config_collider, dic_knobs):
+    os.makedirs(path_store, exist_ok=True)
+    solution = {
+        "context": get_context_hash(config_collider),
+        "targets": get_targets(config_collider),
+        "knobs": dic_knobs,
+    }
+
+    # One file per working point, written atomically so that readers never see a partial file
+    path_solution = f"{path_store}/{get_dict_hash(solution['targets'])}_{solution['context']}.json"
+    path_tmp = f"{path_solution}.tmp.{os.getpid()}"
+    with open(path_tmp, "w") as fid:
+        json.dump(solution, fid)
+    os.replace(path_tmp, path_solution)
+
+
+def get_nearest_knob_solution(path_store, config_collider):
+    # Load all the solutions of the store
+    l_solutions = []
+    for path_solution in glob.glob(f"{path_store}/*.json"):
+        try:
+            with open(path_solution, "r") as fid:
+                l_solutions.append(json.load(fid))
+        except Exception:
+            logging.warning(f"Knob solution {path_solution} could not be read, ignoring it")
+    if len(l_solutions) == 0:
+        return None
+
+    # Favor solutions obtained with the same collider configuration (e.g. same octupoles)
+    context = get_context_hash(config_collider)
+    l_solutions_same_context = [sol for sol in l_solutions if sol["context"] == context]
+    if len(l_solutions_same_context) > 0:
+        l_solutions = l_solutions_same_context
+
+    # Return the solution of the nearest working point (its targets identify the starting point)
+    targets = get_targets(config_collider)
+    nearest_solution = min(l_solutions, key=lambda sol: _get_distance(targets, sol["targets"]))
+    print(f"Warm-starting matching from working point {nearest_solution['targets']['lhcb1']}")
+    return copy.deepcopy(nearest_solution)